@@ -0,0 +1,83 @@
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+
+import hrc_instance
+import hrc_reader
+from pb_model import PBModel
+
+def find_instances(paths, pattern):
+    """Returns the instance files named by paths. Each path may be a file, a glob,
+       or a directory, in which case the files in it matching pattern are used.
+    """
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(sorted(glob.glob(os.path.join(path, pattern))))
+        else:
+            filenames.extend(sorted(glob.glob(path)))
+    return filenames
+
+def output_filename(filename, flatzinc):
+    return os.path.splitext(filename)[0] + (".fzn" if flatzinc else ".opb")
+
+def convert(job):
+    """Convert one instance file, writing the model next to it.
+       Returns a row of the summary table.
+    """
+    filename, max_bp, quiet, flatzinc, presolve, encoding = job
+    start = time.time()
+    try:
+        with open(filename, "rb") as f:
+            data = hrc_reader.read_instance(f)
+        pb_model = PBModel("flatzinc" if flatzinc else "opb", quiet=quiet)
+        instance = hrc_instance.Instance(data, pb_model, max_bp, presolve, encoding)
+        with open(output_filename(filename, flatzinc), "w") as f:
+            instance.write(quiet, f)
+    except Exception as e:
+        return (filename, None, None, None, None, time.time() - start, "{}: {}".format(type(e).__name__, e))
+    return (filename, pb_model.num_vars(), pb_model.num_constrs(),
+            instance.initial_num_prefs, instance.num_prefs(), time.time() - start, "")
+
+def show_summary(rows, f):
+    header = ("instance", "#variable", "#constraint", "prefs", "prefs after presolve", "time (s)", "error")
+    table = [header] + [(filename, str(nvar), str(ncon), str(prefs), str(prefs_after), "{:.2f}".format(t), err)
+                        if nvar is not None else (filename, "-", "-", "-", "-", "{:.2f}".format(t), err)
+                        for filename, nvar, ncon, prefs, prefs_after, t, err in rows]
+    widths = [max(len(row[i]) for row in table) for i in range(len(header))]
+    for row in table:
+        f.write("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() + "\n")
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser("Translate many MIN BP HRC instances to .opb or FlatZinc format in parallel")
+    parser.add_argument("max_bp", type=int,
+            help="The maximum permitted number of blocking pairs")
+    parser.add_argument("paths", nargs="+",
+            help="Instance files, globs, or directories of instance files")
+    parser.add_argument("--pattern", type=str, default="*.txt",
+            help="Instance file pattern for directories (default: *.txt)")
+    parser.add_argument("--jobs", "-j", type=int, default=multiprocessing.cpu_count(),
+            help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument("--quiet", "-q", action="store_true", required=False,
+            help="Suppress most comments in output")
+    parser.add_argument("--flatzinc", "-f", action="store_true", required=False,
+            help="Output FlatZinc")
+    parser.add_argument("--no-presolve", action="store_true", required=False,
+            help="Disable presolve")
+    parser.add_argument("--encoding", choices=["direct", "counter"], default="direct",
+            help="Encoding of hospital space constraints (default: direct)")
+    args = parser.parse_args()
+
+    filenames = find_instances(args.paths, args.pattern)
+    jobs = [(filename, args.max_bp, args.quiet, args.flatzinc, not args.no_presolve, args.encoding)
+            for filename in filenames]
+    pool = multiprocessing.Pool(args.jobs)
+    rows = pool.map(convert, jobs, chunksize=1)
+    pool.close()
+    pool.join()
+    show_summary(rows, sys.stdout)
+    if any(row[-1] for row in rows):
+        sys.exit(1)
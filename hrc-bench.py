@@ -0,0 +1,189 @@
+import argparse
+import collections
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+
+import hrc_generator
+import hrc_instance
+import hrc_reader
+from pb_model import PBModel
+
+# The default benchmark suite: (name, hrc_generator.generate keyword arguments).
+# The instances are generated from fixed seeds, so every run of the suite uses the same inputs.
+SUITE = [
+    ("small-random", dict(nres=200, nhosp=20, ncoup=20, seed=1, pref_len=(3, 6), cap_max=10)),
+    ("medium-random", dict(nres=2000, nhosp=100, ncoup=200, seed=2, pref_len=(3, 8), cap_max=30)),
+    ("medium-master", dict(nres=2000, nhosp=100, ncoup=200, seed=3, pref_len=(3, 8), cap_max=30,
+                           res_correlation=0.8, hosp_correlation=0.8)),
+    ("medium-geometric", dict(nres=2000, nhosp=200, ncoup=400, seed=4, pref_len=(5, 10), cap_max=40,
+                              cap_dist="geometric", res_correlation=0.5)),
+    ("large-random", dict(nres=10000, nhosp=500, ncoup=1000, seed=5, pref_len=(5, 10), cap_max=40)),
+]
+
+class CountingFile(object):
+    "A write-only file object that discards its output and counts the bytes written"
+    def __init__(self):
+        self.size = 0
+
+    def write(self, s):
+        self.size += len(s)
+
+    def flush(self):
+        pass
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_one(data, max_bp, presolve, encoding, flatzinc, stream, result_q):
+    """Convert one instance, measuring each phase. Run in a child process, so that
+       the peak memory use is that of this conversion alone.
+    """
+    try:
+        rss_start = peak_rss_kb()
+        pb_model = PBModel("flatzinc" if flatzinc else "opb", stream, quiet=True)
+        instance = hrc_instance.Instance(data, pb_model, max_bp, presolve, encoding)
+        out = CountingFile()
+        instance.write(True, out)
+        result = instance.stats()
+        result["output_bytes"] = out.size
+        result["peak_rss_kb"] = peak_rss_kb()
+        result["start_rss_kb"] = rss_start
+        result_q.put(result)
+    except Exception as e:
+        result_q.put({"error": "{}: {}".format(type(e).__name__, e)})
+
+def measure(data, max_bp, presolve, encoding, flatzinc, stream):
+    result_q = multiprocessing.Queue()
+    p = multiprocessing.Process(target=run_one,
+            args=(data, max_bp, presolve, encoding, flatzinc, stream, result_q))
+    p.start()
+    result = result_q.get()
+    p.join()
+    return result
+
+def best_of(results):
+    "Combine repeated runs, keeping the minimum of each timing"
+    best = results[0]
+    for result in results[1:]:
+        for phase, t in result["timings"].items():
+            best["timings"][phase] = min(best["timings"][phase], t)
+    return best
+
+def load_instances(filenames, suite):
+    "Returns a list of (name, data) pairs, where data is an hrc_reader.InstanceData"
+    instances = []
+    if suite:
+        for name, params in SUITE:
+            instances.append((name, hrc_reader.parse_instance(hrc_generator.generate(**params))))
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            instances.append((filename, hrc_reader.read_instance(f)))
+    return instances
+
+def git_commit():
+    try:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=directory).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "-uno"], cwd=directory).strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def total_time(result):
+    return sum(result["timings"].values())
+
+def show_results(results, f, baseline=None):
+    """Show a table of results. If baseline (a previous results file) is given,
+       show the time and model size of each run relative to the matching baseline run.
+    """
+    base = {}
+    if baseline is not None:
+        base = {(r["instance"], r["max_bp"]): r for r in baseline["results"] if "error" not in r}
+    header = ["instance", "max_bp", "time (s)", "read", "presolve", "encode", "write",
+              "#variable", "#constraint", "#term", "MB out", "MB peak"]
+    if base:
+        header += ["time vs base", "terms vs base"]
+    table = [header]
+    for r in results:
+        if "error" in r:
+            table.append([r["instance"], str(r["max_bp"]), r["error"]])
+            continue
+        t = r["timings"]
+        encode = sum(t[phase] for phase in ["base_model", "type1", "type2", "type3"])
+        model = r["model"]
+        row = [r["instance"], str(r["max_bp"]), "{:.2f}".format(total_time(r)),
+               "{:.2f}".format(t["parse"] + t["read"]), "{:.2f}".format(t.get("presolve", 0.0)),
+               "{:.2f}".format(encode), "{:.2f}".format(t["write"]),
+               str(model["variables"]), str(model["constraints"]), str(model["terms"]),
+               "{:.1f}".format(r["output_bytes"] / 1e6), "{:.1f}".format(r["peak_rss_kb"] / 1e3)]
+        b = base.get((r["instance"], r["max_bp"]))
+        if b is not None:
+            row += ["{:.2f}x".format(total_time(r) / max(total_time(b), 1e-9)),
+                    "{:.2f}x".format(float(model["terms"]) / max(b["model"]["terms"], 1))]
+        table.append(row)
+    widths = [max(len(row[i]) for row in table if i < len(row)) for i in range(len(header))]
+    for row in table:
+        f.write("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() + "\n")
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser("Benchmark the translation of HRC instances to PB models")
+    parser.add_argument("instances", nargs="*",
+            help="Instance files to benchmark, as well as or instead of the default suite")
+    parser.add_argument("--max-bp", type=int, nargs="+", default=[0, 1, 5],
+            help="Values of max_bp to benchmark (default: 0 1 5)")
+    parser.add_argument("--no-suite", action="store_true", required=False,
+            help="Don't run the default suite of generated instances")
+    parser.add_argument("--repeat", "-r", type=int, default=1,
+            help="Run each conversion this many times, and report the fastest time for each phase")
+    parser.add_argument("--flatzinc", "-f", action="store_true", required=False,
+            help="Benchmark FlatZinc output")
+    parser.add_argument("--no-presolve", action="store_true", required=False,
+            help="Disable presolve")
+    parser.add_argument("--encoding", choices=["direct", "counter"], default="direct",
+            help="Encoding of hospital space constraints (default: direct)")
+    parser.add_argument("--stream", action="store_true", required=False,
+            help="Format constraints while the model is being built")
+    parser.add_argument("--save", type=str, required=False,
+            help="Save the results as JSON to this file")
+    parser.add_argument("--compare", type=str, required=False,
+            help="Compare with results saved by an earlier run with --save")
+    args = parser.parse_args()
+    if args.no_suite and not args.instances:
+        parser.error("no instances to benchmark")
+
+    results = []
+    for name, data in load_instances(args.instances, not args.no_suite):
+        for max_bp in args.max_bp:
+            runs = [measure(data, max_bp, not args.no_presolve, args.encoding, args.flatzinc, args.stream)
+                    for i in range(args.repeat)]
+            errors = [run for run in runs if "error" in run]
+            result = errors[0] if errors else best_of(runs)
+            result["instance"] = name
+            result["max_bp"] = max_bp
+            results.append(result)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    show_results(results, sys.stdout, baseline)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(collections.OrderedDict([
+                    ("commit", git_commit()),
+                    ("date", datetime.datetime.now().isoformat()),
+                    ("python", platform.python_version()),
+                    ("settings", collections.OrderedDict([
+                            ("presolve", not args.no_presolve), ("encoding", args.encoding),
+                            ("flatzinc", args.flatzinc), ("stream", args.stream), ("repeat", args.repeat)])),
+                    ("results", results)]), f, indent=2)
+            f.write("\n")
+    if any("error" in result for result in results):
+        sys.exit(1)
@@ -0,0 +1,67 @@
+import argparse
+import json
+import sys
+
+import hrc_check
+import hrc_instance
+import hrc_reader
+
+def read_assignment(filename, model_instance, pairs):
+    with open(filename) as f:
+        if pairs:
+            return hrc_check.assignment_from_pairs(model_instance.nres, hrc_instance.read_instance_lines(f))
+        return hrc_check.assignment_from_var_names(model_instance, f.read().split())
+
+def show_result(filename, result, max_bp, f):
+    if not result["valid"]:
+        f.write("{}: not a matching\n".format(filename))
+        for error in result["errors"]:
+            f.write("    {}\n".format(error))
+        return
+    f.write("{}: {} blocking pairs ({}){}\n".format(filename, result["total"],
+            ", ".join("{} {}".format(n, t) for t, n in result["blocking_pairs"].items()),
+            "" if max_bp is None or result["total"] <= max_bp else
+                    ", more than max_bp {}".format(max_bp)))
+    for t, r, j in result.get("pairs", []):
+        f.write("    {} resident {} rank {}\n".format(t, r, j))
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser("Check solutions of a MIN BP HRC instance and count their blocking pairs")
+    parser.add_argument("solutions", nargs="+",
+            help="Solution files: names of the variables that are true, as for --show-sol in hrc-to-pb.py")
+    parser.add_argument("--max-bp", type=int, required=False,
+            help="The max_bp of the model that the solutions are for. Needed to read variable names "
+                 "of a presolved model; solutions with more blocking pairs are reported")
+    parser.add_argument("--no-presolve", action="store_true", required=False,
+            help="The model was built without presolve")
+    parser.add_argument("--pairs", action="store_true", required=False,
+            help="Solution files list \"resident hospital\" pairs, rather than variable names")
+    parser.add_argument("--list", "-l", action="store_true", required=False,
+            help="List the blocking pairs")
+    parser.add_argument("--json", action="store_true", required=False,
+            help="Write the results as JSON")
+    args = parser.parse_args()
+    if args.max_bp is None and not (args.no_presolve or args.pairs):
+        parser.error("--max-bp is required to read variable names, unless the model wasn't presolved")
+
+    data = hrc_reader.read_instance(sys.stdin)
+    instance = hrc_instance.Instance(data, None, args.max_bp, False)
+    model_instance = instance
+    if not (args.no_presolve or args.pairs):
+        # Variable names give positions in the presolved preference lists
+        model_instance = hrc_instance.Instance(data, None, args.max_bp, True)
+    checker = hrc_check.StabilityChecker(instance)
+
+    results = []
+    for filename in args.solutions:
+        result = checker.check(read_assignment(filename, model_instance, args.pairs), args.list)
+        result["solution"] = filename
+        results.append(result)
+        if not args.json:
+            show_result(filename, result, args.max_bp, sys.stdout)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    if not all(result["valid"] and (args.max_bp is None or result["total"] <= args.max_bp)
+               for result in results):
+        sys.exit(1)
@@ -0,0 +1,240 @@
+import argparse
+import itertools
+import os
+import random
+import shlex
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+
+import hrc_generator
+import hrc_instance
+import hrc_reader
+import hrc_solve
+import pb_cnf
+from pb_model import COMPS, PBModel
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Ways of building a model: (name, Instance presolve, encoding, PBModel presolve). The first,
+# the plain model, is the reference that the others are compared with.
+VARIANTS = [
+    ("no-presolve", False, "direct", False),
+    ("presolve", True, "direct", True),
+    ("no-model-presolve", True, "direct", False),
+    ("counter", True, "counter", True),
+]
+
+def solve(command, model):
+    "Run the PB solver on the .opb model text; returns (status, objective)"
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+    output, _ = proc.communicate(model)
+    status, objective, true_vars = hrc_solve.parse_solver_output(output.splitlines())
+    return status, objective
+
+def write_model(data, max_bp, presolve, encoding, fmt, model_presolve=True, card_encoding="totalizer"):
+    instance = hrc_instance.Instance(data, PBModel(fmt, quiet=True, presolve=model_presolve,
+                                                   card_encoding=card_encoding), max_bp, presolve, encoding)
+    out = StringIO.StringIO()
+    instance.write(True, out)
+    return out.getvalue()
+
+def wcnf_to_opb(text):
+    """Rewrite a WCNF model as an .opb model whose minimum is the WCNF model's minimum cost:
+       each hard clause is a constraint, and each soft clause has a relaxation variable,
+       whose weight is in the objective. Returns (model, penalty weight).
+    """
+    weight = None
+    constrs = []
+    objective = []
+    for line in text.splitlines():
+        if line.startswith("c Objective:"):
+            weight = int(line.split()[-1])
+        elif line.startswith("p wcnf"):
+            num_vars, num_clauses, top = [int(x) for x in line.split()[2:]]
+        elif line and not line.startswith("c"):
+            values = [int(x) for x in line.split()[:-1]]
+            terms = ["+1 {}x{}".format("~" if lit < 0 else "", abs(lit)) for lit in values[1:]]
+            if values[0] < top:
+                num_vars += 1
+                terms.append("+1 x{}".format(num_vars))
+                objective.append("+{} x{}".format(values[0], num_vars))
+            constrs.append("{} >= 1;".format(" ".join(terms) if terms else "0 x1"))
+    return "\n".join(["min: {};".format(" ".join(objective))] + constrs) + "\n", weight
+
+def check_instance(data, max_bp, command):
+    """Solve the models of every variant for each bound up to max_bp, and the WCNF models for
+       max_bp with each cardinality encoding. Returns a list of mismatches with the reference.
+    """
+    errors = []
+    reference = []
+    for bp in range(max_bp + 1):
+        results = [(name, solve(command, write_model(data, bp, presolve, encoding, "opb", model_presolve)))
+                   for name, presolve, encoding, model_presolve in VARIANTS]
+        reference.append(results[0][1])
+        errors.extend("max_bp {}: {} gives {}, but {} gives {}".format(bp, name, result, VARIANTS[0][0],
+                      reference[bp]) for name, result in results[1:] if result != reference[bp])
+
+    # A WCNF model's minimum has as few blocking pairs as possible, and of those matchings, a largest
+    # one, whose objective is the .opb optimum for the smallest bound with a solution
+    sat = [bp for bp, (status, objective) in enumerate(reference) if status == "optimum"]
+    expected = (sat[0], -reference[sat[0]][1]) if sat else None
+    for card_encoding in ["totalizer", "counter"]:
+        model, weight = wcnf_to_opb(write_model(data, max_bp, True, "direct", "wcnf", card_encoding=card_encoding))
+        status, cost = solve(command, model)
+        result = (cost // weight, weight - 1 - cost % weight) if status == "optimum" else None
+        if result != expected:
+            errors.append("max_bp {}: wcnf with {} encoding gives (blocking pairs, score) {}, but the .opb "
+                          "models give {}".format(max_bp, card_encoding, result, expected))
+    return errors
+
+def check_stats(data, max_bp):
+    """Check that the size of each variant's .opb model, streamed or not, in PBModel.stats is
+       the size in its header and the size written. Returns a list of mismatches.
+    """
+    errors = []
+    for name, presolve, encoding, model_presolve in VARIANTS:
+        for stream in [False, True]:
+            pb_model = PBModel("opb", stream, quiet=True, presolve=model_presolve)
+            instance = hrc_instance.Instance(data, pb_model, max_bp, presolve, encoding)
+            out = StringIO.StringIO()
+            instance.write(True, out)
+            lines = out.getvalue().splitlines()
+            header = lines[0].split()
+            constrs = [line for line in lines if line.endswith(";") and not line.startswith("min:")]
+            written = (int(header[2]), int(header[4]), len(constrs),
+                       sum(token.startswith("x") for line in constrs for token in line.split()))
+            stats = pb_model.stats()
+            expected = (stats["variables"], stats["constraints"], stats["constraints"], stats["terms"])
+            if (written != expected or sum(stats["variables_by_name"].values()) != stats["variables"] or
+                    sum(stats["constraints_by_name"].values()) != stats["constraints"]):
+                errors.append("max_bp {}: {}{} model has (variables, constraints, constraint lines, terms) {}, "
+                              "but its stats give {}".format(max_bp, name, " streamed" if stream else "",
+                                                             written, expected))
+    return errors
+
+def check_cache(lines, max_bp):
+    """Check that hrc-to-pb.py writes the same model for each bound up to max_bp whether or not
+       the instance is read from its cache, after a sweep over the bounds has used the cache.
+       Returns a list of mismatches.
+    """
+    text = "\n".join(lines) + "\n"
+    cache_dir = tempfile.mkdtemp()
+    def run(*args):
+        proc = subprocess.Popen([sys.executable, os.path.join(DIRECTORY, "hrc-to-pb.py")] + list(args),
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+        return proc.communicate(text)[0]
+    errors = []
+    try:
+        run("--cache-dir", cache_dir, "--max-bp-range", "0", str(max_bp),
+            "--output", os.path.join(cache_dir, "sweep{}.opb"))
+        for bp in range(max_bp + 1):
+            model = run(str(bp))
+            # The first run may add the instance to the cache, and the second reads it from there
+            for attempt in ["first", "second"]:
+                if run("--cache-dir", cache_dir, str(bp)) != model:
+                    errors.append("max_bp {}: the {} run with the cache writes a different model".format(
+                                  bp, attempt))
+    finally:
+        shutil.rmtree(cache_dir)
+    return errors
+
+class ClauseCollector(object):
+    "Collects the clauses written by a pb_cnf.CNFEncoder"
+    def __init__(self):
+        self.clauses = []
+
+    def write(self, line):
+        self.clauses.append([int(x) for x in line.split()[:-1]])
+
+def satisfiable(clauses, assignment):
+    """Can assignment, a dict from variables to values, be extended to satisfy clauses?
+       A plain DPLL search, which is enough for the clauses of one small constraint.
+    """
+    assignment = dict(assignment)
+    changed = True
+    while changed:
+        changed = False
+        branch_clause = None
+        for clause in clauses:
+            if any(assignment.get(abs(lit)) == (lit > 0) for lit in clause):
+                continue
+            free = [lit for lit in clause if abs(lit) not in assignment]
+            if not free:
+                return False
+            if len(free) == 1:
+                assignment[abs(free[0])] = free[0] > 0
+                changed = True
+            elif branch_clause is None:
+                branch_clause = free
+    if branch_clause is None:
+        return True
+    var = abs(branch_clause[0])
+    for value in (True, False):
+        assignment[var] = value
+        if satisfiable(clauses, assignment):
+            return True
+    return False
+
+def check_encoder(rng, card_encoding):
+    """Encode a random constraint on a few variables with pb_cnf.CNFEncoder, and check that the
+       assignments of those variables that can be extended to satisfy the clauses are exactly
+       the ones that satisfy the constraint. Returns a list of mismatches.
+    """
+    n = rng.randint(1, 7)
+    if rng.random() < 0.5:
+        coefs = [rng.choice([-1, 1]) for i in range(n)]   # a cardinality constraint
+    else:
+        coefs = [rng.choice([-3, -2, -1, 1, 2, 3, 5]) for i in range(n)]
+    comp = rng.choice(COMPS)
+    rhs = rng.randint(-4, 6)
+    out = ClauseCollector()
+    pb_cnf.CNFEncoder(n, out, "", card_encoding, rng.choice([0, 6])).add_constr(coefs, range(n), comp, rhs)
+    errors = []
+    for values in itertools.product([False, True], repeat=n):
+        total = sum(c for c, value in zip(coefs, values) if value)
+        holds = total <= rhs if comp == "<=" else total >= rhs if comp == ">=" else total == rhs
+        if satisfiable(out.clauses, {v + 1: value for v, value in enumerate(values)}) != holds:
+            errors.append("{} encoding of {} {} {} is {} for {}".format(card_encoding, coefs, comp, rhs,
+                          not holds, [int(value) for value in values]))
+            break
+    return errors
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser("Check that presolve, the hospital space encoding and the WCNF "
+                                     "encoding don't change the optima of small random instances' models, "
+                                     "that the instance cache doesn't change them, that the model stats match "
+                                     "the models, and that the CNF encoding of random constraints is exact")
+    parser.add_argument("--solver", type=str,
+            default="{} {}".format(sys.executable, os.path.join(DIRECTORY, "tiny-pb-solver.py")),
+            help="PB solver command line, which reads the model on stdin and writes its results in "
+                 "the PB competition format (default: tiny-pb-solver.py)")
+    parser.add_argument("--seeds", type=int, default=20,
+            help="Number of random instances (default: 20)")
+    parser.add_argument("--max-bp", type=int, default=2,
+            help="Check each max_bp from 0 to this (default: 2)")
+    parser.add_argument("--encoder-trials", type=int, default=500,
+            help="Number of random constraints on which to check each CNF cardinality encoding (default: 500)")
+    args = parser.parse_args()
+
+    command = shlex.split(args.solver)
+    num_errors = 0
+    for seed in range(1, args.seeds + 1):
+        # Small instances of varied shapes, which the solver can solve exactly
+        lines = hrc_generator.generate(8 + seed % 5, 2 + seed % 3, seed % 3, seed, (1, 4), 1, 1 + seed % 3,
+                                       res_correlation=seed % 4 / 4.0)
+        errors = check_instance(hrc_reader.parse_instance(lines), args.max_bp, command)
+        errors += check_stats(hrc_reader.parse_instance(lines), args.max_bp)
+        errors += check_cache(lines, args.max_bp)
+        print "seed {}: {}".format(seed, "; ".join(errors) if errors else "ok")
+        sys.stdout.flush()
+        num_errors += len(errors)
+    rng = random.Random(0)
+    for card_encoding in pb_cnf.CARD_ENCODINGS:
+        errors = [error for trial in range(args.encoder_trials) for error in check_encoder(rng, card_encoding)]
+        print "CNF encoder with {}: {}".format(card_encoding, "; ".join(errors) if errors else "ok")
+        num_errors += len(errors)
+    print "{} mismatches".format(num_errors)
+    sys.exit(1 if num_errors else 0)
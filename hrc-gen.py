@@ -0,0 +1,31 @@
+import argparse
+import sys
+
+import hrc_generator
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser("Generate a random HRC instance")
+    parser.add_argument("nres", type=int,
+            help="Number of residents, including the members of couples")
+    parser.add_argument("nhosp", type=int,
+            help="Number of hospitals")
+    parser.add_argument("--couples", "-c", type=int, default=0,
+            help="Number of couples (default: 0)")
+    parser.add_argument("--seed", "-s", type=int, default=0,
+            help="Random seed (default: 0)")
+    parser.add_argument("--pref-len", type=int, nargs=2, metavar=("MIN", "MAX"), default=[5, 5],
+            help="Range of preference list lengths (default: 5 5)")
+    parser.add_argument("--cap", type=int, nargs=2, metavar=("MIN", "MAX"), default=[1, 3],
+            help="Range of hospital capacities (default: 1 3)")
+    parser.add_argument("--cap-dist", choices=hrc_generator.CAP_DISTS, default="uniform",
+            help="Distribution of hospital capacities (default: uniform)")
+    parser.add_argument("--res-correlation", type=float, default=0.0,
+            help="How closely residents' preferences follow a master list, from 0 (independent) "
+                 "to 1 (identical) (default: 0)")
+    parser.add_argument("--hosp-correlation", type=float, default=0.0,
+            help="How closely hospitals' preferences follow a master list (default: 0)")
+    args = parser.parse_args()
+
+    lines = hrc_generator.generate(args.nres, args.nhosp, args.couples, args.seed, args.pref_len,
+            args.cap[0], args.cap[1], args.cap_dist, args.res_correlation, args.hosp_correlation)
+    sys.stdout.write("\n".join(lines) + "\n")
@@ -0,0 +1,91 @@
+import argparse
+import json
+import multiprocessing
+import sys
+
+import hrc_heuristic
+import hrc_instance
+import hrc_reader
+import hrc_solve
+
+def show_runs(runs, f, indent=""):
+    for run in runs:
+        f.write("{}max_bp {:<4} {:<14} objective {:<8} {:.2f}s{}\n".format(indent, run["max_bp"], run["status"],
+                run["objective"], run["time"], " (timed out)" if run["timed_out"] else ""))
+
+def show_solution(solution, check, f):
+    if "components" in solution:
+        for component in solution["components"]:
+            f.write("Component {}: {} residents, {} hospitals, {} prefs: max_bp {}{}\n".format(
+                    component["component"], component["residents"], component["hospitals"],
+                    component["prefs"], component["max_bp"], "" if component["proven"] else " (not proven)"))
+            show_runs(component["runs"], f, "    ")
+    else:
+        show_runs(solution["runs"], f)
+    if solution["max_bp"] is None:
+        f.write("No solution found\n")
+        return
+    f.write("Smallest max_bp with a solution: {}{}\n".format(solution["max_bp"],
+            "" if solution["proven"] else " (smaller bounds are undecided)"))
+    best = solution["best"]
+    if "matching" in best:
+        f.write("Matching: {} residents assigned, {}\n".format(hrc_heuristic.num_assigned(best["matching"]),
+                "optimal" if best["status"] == "optimum" else "not proven optimal"))
+    if check is not None:
+        if check["valid"]:
+            f.write("Checked: {} blocking pairs ({})\n".format(check["total"],
+                    ", ".join("{} {}".format(n, t) for t, n in check["blocking_pairs"].items())))
+        else:
+            f.write("Checked: not a matching: {}\n".format("; ".join(check["errors"])))
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser("Solve a MIN BP HRC instance with a PB solver, "
+                                     "running the models for several values of max_bp in parallel")
+    parser.add_argument("--solver", type=str, required=True,
+            help="Solver command line. The model is given on stdin, and {} is replaced by /dev/stdin. "
+                 "The solver must write its results in the PB competition format")
+    parser.add_argument("--range", type=int, nargs=2, metavar=("LO", "HI"), required=False,
+            help="Range of max_bp to search (default: from 0 to the number of blocking pairs "
+                 "of a heuristic matching)")
+    parser.add_argument("--bisect", action="store_true", required=False,
+            help="Bisect the range, rather than racing the smallest undecided bounds")
+    parser.add_argument("--jobs", "-j", type=int, default=multiprocessing.cpu_count(),
+            help="Number of solver processes to run at once (default: number of CPUs)")
+    parser.add_argument("--timeout", type=float, required=False,
+            help="Time limit in seconds for each solver run")
+    parser.add_argument("--no-presolve", action="store_true", required=False,
+            help="Disable presolve")
+    parser.add_argument("--encoding", choices=["direct", "counter"], default="direct",
+            help="Encoding of hospital space constraints (default: direct)")
+    parser.add_argument("--heuristic-time", type=float, default=10.0,
+            help="Time limit in seconds for the heuristic's local search (default: 10)")
+    parser.add_argument("--components", action="store_true", required=False,
+            help="Split the instance into its connected components, after presolving for HI, and "
+                 "search each component's bounds from 0 separately (LO is not used); the instance's smallest "
+                 "max_bp is the sum of the components'")
+    parser.add_argument("--json", action="store_true", required=False,
+            help="Write the results, including the matching, as JSON")
+    args = parser.parse_args()
+
+    instance = hrc_instance.Instance(hrc_reader.read_instance(sys.stdin), None, None,
+            not args.no_presolve, args.encoding)
+    matching = None
+    if args.range:
+        lo, hi = args.range
+    else:
+        matching, num_bp = hrc_heuristic.find_matching(instance, time_limit=args.heuristic_time)
+        lo, hi = 0, num_bp
+    strategy = "bisect" if args.bisect else "race"
+    if args.components:
+        solution = hrc_solve.solve_components(instance, args.solver, hi, args.jobs, args.timeout, strategy,
+                                              matching)
+    else:
+        driver = hrc_solve.Driver(instance, args.solver, args.jobs, args.timeout)
+        solution = driver.solve(lo, hi, strategy)
+    check = hrc_solve.check_solution(instance, solution)
+    if args.json:
+        solution["check"] = check
+        json.dump(solution, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        show_solution(solution, check, sys.stdout)
@@ -1,34 +1,265 @@
 import argparse
+import collections
+import json
+import multiprocessing
 import sys
+import time
 
+import hrc_cache
+import hrc_heuristic
 import hrc_instance
-from pb_model import PBModel
+import hrc_reader
+from pb_cnf import CARD_ENCODINGS
+from pb_model import FORMATS, PBModel, STREAM_FORMATS
             
-def main(lines, max_bp, quiet, flatzinc, presolve):
-    instance = hrc_instance.Instance(lines, PBModel(flatzinc), max_bp, presolve)
-    instance.write(quiet)
+def write(instance, quiet, output, stats, hint_file=None):
+    """Write the instance's model to file output, or stdout if output is None.
+       stats is None, "comments" (add instrumentation to the model's comments before
+       writing it) or "json" (write instrumentation to stderr after writing the model).
+       If hint_file is given, an .opb model's hint (if any) is written to it.
+    """
+    if stats == "comments":
+        instance.add_stats_comments()
+    if output:
+        with open(output, "w") as f:
+            instance.write(quiet, f)
+    else:
+        instance.write(quiet)
+    pb_model = instance.pb_model
+    if hint_file and pb_model.hint and pb_model.fmt == "opb":
+        with open(hint_file, "w") as f:
+            pb_model.write_hint(f)
+    if stats == "json":
+        json.dump(instance.stats(), sys.stderr, indent=2)
+        sys.stderr.write("\n")
+
+def get_instance(data, max_bp, presolve, encoding, cache, instance=None):
+    """Returns the instance read from data (see hrc_reader), presolved for max_bp if presolve is True and max_bp
+       isn't None. If instance is given, it is the same instance, presolved for a larger max_bp
+       or not yet presolved, and presolve continues from it. If cache is given, the instance
+       is looked up in it first, and added to it otherwise, unless presolve continued from a
+       larger max_bp: that gives the same lists as a fresh presolve, but different presolve
+       stats, which would make a model built from the cache differ from one built from the text.
+    """
+    if cache is not None:
+        start = time.time()
+        cached = cache.get(data, max_bp, presolve, encoding)
+        if cached is not None:
+            cached.timings["cache_load"] = time.time() - start
+            return cached
+    if instance is None:
+        instance = hrc_instance.Instance(data, None, max_bp, presolve, encoding)
+    elif max_bp is not None:
+        if instance.presolve_stats is not None:
+            cache = None
+        instance.tighten_max_bp(max_bp)
+    if cache is not None:
+        cache.put(data, instance)
+    return instance
+
+def find_warm_start(instance, time_limit):
+    "Run the heuristic on the (not yet presolved) instance; returns (matching, number of blocking pairs)"
+    with instance.timed("heuristic"):
+        return hrc_heuristic.find_matching(instance, time_limit=time_limit)
+
+def add_warm_start(instance, matching, num_bp):
+    instance.add_hint(matching)
+    instance.pb_model.add_comment("Warm start: heuristic matching with {} residents assigned and {} blocking pairs"
+            .format(hrc_heuristic.num_assigned(matching), num_bp))
+
+def main(data, max_bp, quiet, fmt, presolve, encoding, stream, output, stats, warm_start, hint_file,
+         cache, model_presolve=True, card_encoding="totalizer"):
+    """If warm_start is not None, a heuristic matching, found within warm_start seconds, is given to
+       the solver as a hint, and its number of blocking pairs is used as max_bp if max_bp is None.
+       cache is an hrc_cache.InstanceCache, or None. fmt, model_presolve and card_encoding are
+       passed to PBModel.
+    """
+    instance = None
+    if warm_start is not None:
+        instance = get_instance(data, None, presolve, encoding, cache)
+        matching, num_bp = find_warm_start(instance, warm_start)
+        if max_bp is None:
+            max_bp = num_bp
+    instance = get_instance(data, max_bp, presolve, encoding, cache, instance)
+    instance.build_model(PBModel(fmt, stream, quiet, model_presolve, card_encoding))
+    if warm_start is not None:
+        add_warm_start(instance, matching, num_bp)
+    write(instance, quiet, output, stats, hint_file)
+
+def sweep(data, max_bps, quiet, fmt, presolve, encoding, stream, output, stats, warm_start, cache,
+          model_presolve=True, card_encoding="totalizer"):
+    """Write one model for each value of max_bp in max_bps, to output.format(max_bp).
+       The instance is parsed once, and the models are built in decreasing order of max_bp
+       so that each presolve continues from the previous one. A warm start hint
+       is written to output.format(max_bp) + ".hint" for .opb models.
+    """
+    max_bps = sorted(max_bps, reverse=True)
+    instance = None
+    if warm_start is not None:
+        instance = get_instance(data, None, presolve, encoding, cache)
+        matching, num_bp = find_warm_start(instance, warm_start)
+    for max_bp in max_bps:
+        instance = get_instance(data, max_bp, presolve, encoding, cache, instance)
+        instance.build_model(PBModel(fmt, stream, quiet, model_presolve, card_encoding))
+        if warm_start is not None:
+            add_warm_start(instance, matching, num_bp)
+        write(instance, quiet, output.format(max_bp), stats, output.format(max_bp) + ".hint")
+
+def write_component(job):
+    """Build and write the model of one component of an instance (see write_components).
+       Returns the component's entry in the report.
+    """
+    (k, num_components, instance, res_ids, hosp_ids, quiet, fmt, stream, model_presolve, card_encoding,
+            output, stats) = job
+    instance.build_model(PBModel(fmt, stream, quiet, model_presolve, card_encoding))
+    instance.pb_model.add_comment("Component {} of {}, with residents and hospitals renumbered".format(
+            k, num_components))
+    write(instance, quiet, output.format(k), stats)
+    return collections.OrderedDict([("component", k), ("output", output.format(k)),
+            ("residents", instance.nres), ("couples", instance.ncoup), ("hospitals", instance.nhosp),
+            ("prefs", instance.num_prefs()), ("model", instance.pb_model.stats()),
+            ("res_ids", res_ids), ("hosp_ids", hosp_ids)])
+
+def write_components(data, max_bp, quiet, fmt, presolve, encoding, stream, output, stats, cache,
+                     report_file, jobs, model_presolve=True, card_encoding="totalizer"):
+    """Split the instance, presolved for max_bp, into its connected components (see
+       Instance.components), and write the model of component k to output.format(k), using
+       jobs processes. No blocking pair spans two components, so the instance's smallest
+       number of blocking pairs is the sum of the components' (see hrc-solve.py --components).
+       Each component is allowed all max_bp blocking pairs, as it could need the whole budget.
+       The components' sizes are written to stderr as a table, and to report_file as JSON,
+       with the original ids of their residents and hospitals.
+    """
+    instance = get_instance(data, max_bp, presolve, encoding, cache)
+    components = instance.components()
+    tasks = [(k, len(components)) + instance.subinstance(residents, hospitals) +
+            (quiet, fmt, stream, model_presolve, card_encoding, output, stats)
+            for k, (residents, hospitals) in enumerate(components)]
+    pool = multiprocessing.Pool(jobs)
+    reports = pool.map(write_component, tasks, chunksize=1)
+    pool.close()
+    pool.join()
+    show_components(reports, sys.stderr)
+    with open(report_file, "w") as f:
+        json.dump(reports, f, indent=2)
+        f.write("\n")
+
+def show_components(reports, f):
+    header = ("component", "residents", "couples", "hospitals", "prefs", "#variable", "#constraint", "#term")
+    table = [header] + [tuple(str(x) for x in (report["component"], report["residents"], report["couples"],
+                        report["hospitals"], report["prefs"], report["model"]["variables"],
+                        report["model"]["constraints"], report["model"]["terms"]))
+                        for report in reports]
+    widths = [max(len(row[i]) for row in table) for i in range(len(header))]
+    for row in table:
+        f.write("  ".join(cell.rjust(width) for cell, width in zip(row, widths)) + "\n")
 
-def show_sol(lines, sol_filename):
-    instance = hrc_instance.Instance(lines, PBModel(False), 0, False)
+def show_sol(data, sol_filename):
+    instance = hrc_instance.Instance(data, PBModel("opb"), 0, False)
     instance.show_sol(sol_filename)
 
 if __name__=="__main__":
-    parser = argparse.ArgumentParser("Translate a MIN BP HRC instance to .opb format")
-    parser.add_argument("max_bp", type=int,
+    parser = argparse.ArgumentParser("Translate a MIN BP HRC instance to .opb format (or FlatZinc, WCNF, LP or MPS)")
+    parser.add_argument("max_bp", type=int, nargs="?",
             help="The maximum permitted number of blocking pairs")
     parser.add_argument("--quiet", "-q", action="store_true", required=False,
             help="Suppress most comments in output")
     parser.add_argument("--flatzinc", "-f", action="store_true", required=False,
-            help="Output FlatZinc")
+            help="Output FlatZinc (the same as --format flatzinc)")
+    parser.add_argument("--format", choices=FORMATS, default="opb",
+            help="Output format (default: opb). wcnf (weighted MaxSAT), lp (CPLEX LP) and mps (free MPS) "
+                 "have a single objective that minimises the number of blocking pairs and then maximises "
+                 "the matching, so one optimisation run replaces the decision runs for each max_bp; "
+                 "max_bp is still a hard bound, so it should be an upper bound such as --warm-start's")
+    parser.add_argument("--card-encoding", choices=CARD_ENCODINGS, default="totalizer",
+            help="CNF encoding of cardinality constraints for --format wcnf; constraints with unequal "
+                 "coefficients use an adder network (default: totalizer). --encoding counter keeps "
+                 "the WCNF much smaller, as the direct encoding's repeated prefixes are each encoded")
     parser.add_argument("--no-presolve", action="store_true", required=False,
             help="Disable presolve")
+    parser.add_argument("--no-model-presolve", action="store_true", required=False,
+            help="Write the constraints as they were generated, without the generic PB presolve "
+                 "(fixing variables, merging terms, tightening coefficients, dropping redundant constraints)")
+    parser.add_argument("--encoding", choices=["direct", "counter"], default="direct",
+            help="Encoding of hospital space constraints (default: direct)")
+    parser.add_argument("--stream", action="store_true", required=False,
+            help="Format constraints while the model is being built, rather than keeping them in memory")
+    parser.add_argument("--output", "-o", type=str, required=False,
+            help="Write the model to this file, rather than to stdout")
+    parser.add_argument("--max-bp-range", type=int, nargs=2, metavar=("LO", "HI"), required=False,
+            help="Write a model for each max_bp from LO to HI inclusive, to the file named by "
+                 "--output with {} replaced by max_bp")
+    parser.add_argument("--components", type=str, metavar="REPORT", required=False,
+            help="Split the instance into its connected components, and write a model for each, in parallel, "
+                 "to the file named by --output with {} replaced by the component number. Each model "
+                 "allows max_bp blocking pairs. The components' sizes and original resident and hospital "
+                 "ids are written to REPORT as JSON")
+    parser.add_argument("--jobs", "-j", type=int, default=multiprocessing.cpu_count(),
+            help="Number of worker processes for --components (default: number of CPUs)")
+    parser.add_argument("--stats", choices=["json", "comments"], required=False,
+            help="Report phase timings, presolve reductions and model size, as JSON on stderr "
+                 "or as comments in the .opb output")
+    parser.add_argument("--warm-start", action="store_true", required=False,
+            help="Find a matching with few blocking pairs by a heuristic, and give it to the solver as a hint: "
+                 "a warm_start annotation in FlatZinc, or a hint file for .opb. If max_bp isn't given, "
+                 "the matching's number of blocking pairs is used")
+    parser.add_argument("--heuristic-time", type=float, default=10.0,
+            help="Time limit in seconds for the heuristic's local search (default: 10)")
+    parser.add_argument("--hint-file", type=str, required=False,
+            help="File for the .opb hint, as a solver's v line (default: the --output file name plus .hint)")
+    parser.add_argument("--cache-dir", type=str, required=False,
+            help="Directory of a cache of read and presolved instances, to reuse between runs")
+    parser.add_argument("--cache-max-mb", type=int, default=1024,
+            help="Maximum size of the cache in MB; the least recently used entries are removed (default: 1024)")
+    parser.add_argument("--cache-max-days", type=float, default=30,
+            help="Remove cache entries not used for this many days (default: 30)")
     parser.add_argument("--show-sol", type=str, required=False,
             help="Show a solution from file")
     args = parser.parse_args()
+    fmt = "flatzinc" if args.flatzinc else args.format
+    if args.flatzinc and args.format not in ("opb", "flatzinc"):
+        parser.error("--flatzinc can't be used with --format {}".format(args.format))
+    if args.stream and fmt not in STREAM_FORMATS:
+        parser.error("--stream can only be used with --format {}".format(" or ".join(STREAM_FORMATS)))
+    if args.max_bp_range:
+        if args.max_bp is not None or args.components:
+            parser.error("max_bp and --components can't be used with --max-bp-range")
+        if not args.output or "{}" not in args.output:
+            parser.error("--max-bp-range requires an --output file name containing {}")
+        if args.max_bp_range[0] > args.max_bp_range[1]:
+            parser.error("--max-bp-range LO must not be greater than HI")
+    elif args.components:
+        if args.max_bp is None:
+            parser.error("--components requires max_bp")
+        if not args.output or "{}" not in args.output:
+            parser.error("--components requires an --output file name containing {}")
+        if args.warm_start or args.stats == "json":
+            parser.error("--components can't be used with --warm-start or --stats json")
+    elif args.max_bp is None and not args.warm_start:
+        parser.error("max_bp is required, unless --warm-start is used")
+    hint_file = args.hint_file or (args.output + ".hint" if args.output else None)
+    if args.warm_start and fmt == "opb" and not hint_file:
+        parser.error("--warm-start with .opb output requires --hint-file or --output")
+    warm_start = args.heuristic_time if args.warm_start else None
+    cache = None
+    if args.cache_dir:
+        cache = hrc_cache.InstanceCache(args.cache_dir, args.cache_max_mb << 20, args.cache_max_days * 24 * 3600)
     
     if args.show_sol:
-        show_sol([line.strip() for line in sys.stdin.readlines() if line.strip()],
+        show_sol(hrc_reader.read_instance(sys.stdin),
                 args.show_sol)
+    elif args.components:
+        write_components(hrc_reader.read_instance(sys.stdin),
+                args.max_bp, args.quiet, fmt, not args.no_presolve, args.encoding, args.stream,
+                args.output, args.stats, cache, args.components, args.jobs, not args.no_model_presolve,
+                args.card_encoding)
+    elif args.max_bp_range:
+        sweep(hrc_reader.read_instance(sys.stdin),
+                range(args.max_bp_range[0], args.max_bp_range[1] + 1), args.quiet, fmt,
+                not args.no_presolve, args.encoding, args.stream, args.output, args.stats, warm_start, cache,
+                not args.no_model_presolve, args.card_encoding)
     else:
-        main([line.strip() for line in sys.stdin.readlines() if line.strip()],
-                args.max_bp, args.quiet, args.flatzinc, not args.no_presolve)
+        main(hrc_reader.read_instance(sys.stdin),
+                args.max_bp, args.quiet, fmt, not args.no_presolve, args.encoding,
+                args.stream, args.output, args.stats, warm_start, hint_file, cache, not args.no_model_presolve,
+                args.card_encoding)
@@ -0,0 +1,150 @@
+from array import array
+import collections
+import glob
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import time
+
+import hrc_instance
+
+MAGIC = 0x48524331   # "HRC1"; also detects a cache written with the other byte order
+VERSION = 1
+HEADER = ["magic", "version", "nres", "nhosp", "ncoup", "npost", "initial_num_prefs",
+          "num_rprefs", "num_hprefs", "stats_len"]
+
+def flatten(lists):
+    "Returns (offsets, items) arrays for a list of lists of ints"
+    offsets = array('i', [0])
+    items = array('i')
+    for l in lists:
+        items.extend(l)
+        offsets.append(len(items))
+    return offsets, items
+
+def unflatten(offsets, items):
+    return [items[offsets[k]:offsets[k+1]].tolist() for k in range(len(offsets) - 1)]
+
+class InstanceCache(object):
+    """An on-disk cache of read and presolved instances, keyed by a hash of the instance text,
+       max_bp and the presolve flag. Each entry is a file holding the preference lists and
+       capacities as flat arrays of ints, which is memory-mapped when it is loaded.
+
+       When an entry is added, entries older than max_age seconds are removed, and then
+       the least recently used entries are removed until the cache is at most max_bytes.
+    """
+    def __init__(self, cache_dir, max_bytes=1 << 30, max_age=30 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def filename(self, data, max_bp, presolve):
+        h = hashlib.sha1()
+        h.update("{} {} {}\n".format(VERSION, max_bp if presolve else None, presolve))
+        h.update(data.digest)
+        return os.path.join(self.cache_dir, h.hexdigest() + ".hrc")
+
+    def get(self, data, max_bp, presolve, encoding="direct"):
+        """Returns the instance read from data (see hrc_reader) and, if presolve is True, presolved for max_bp,
+           or None if it isn't in the cache
+        """
+        filename = self.filename(data, max_bp, presolve)
+        try:
+            f = open(filename, "rb")
+        except IOError:
+            return None
+        instance = None
+        with f:
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                pass   # e.g. an empty file
+            else:
+                try:
+                    instance = self.load(m, max_bp, presolve, encoding)
+                finally:
+                    m.close()
+        if instance is None:
+            # A damaged entry, e.g. truncated by a full disk: remove it, and treat it as a miss
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            return None
+        os.utime(filename, None)   # for least recently used eviction
+        return instance
+
+    def load(self, m, max_bp, presolve, encoding):
+        "Returns the instance in the entry m, or None if the entry is damaged"
+        itemsize = array('i').itemsize
+        pos = [0]
+        def read_ints(n):
+            a = array('i')
+            a.fromstring(m[pos[0]:pos[0] + n * itemsize])
+            pos[0] += n * itemsize
+            return a
+        if len(m) < len(HEADER) * itemsize:
+            return None
+        header = dict(zip(HEADER, read_ints(len(HEADER))))
+        if header["magic"] != MAGIC or header["version"] != VERSION or min(header.values()) < 0:
+            return None
+        nres, nhosp = header["nres"], header["nhosp"]
+        num_ints = len(HEADER) + nhosp + nres + 1 + header["num_rprefs"] + nhosp + 1 + header["num_hprefs"]
+        if len(m) != num_ints * itemsize + header["stats_len"]:
+            return None
+        hosp_cap = read_ints(nhosp).tolist()
+        roffsets, rprefs = read_ints(nres + 1), read_ints(header["num_rprefs"])
+        hoffsets, hprefs = read_ints(nhosp + 1), read_ints(header["num_hprefs"])
+        if roffsets[0] != 0 or roffsets[-1] != len(rprefs) or hoffsets[0] != 0 or hoffsets[-1] != len(hprefs):
+            return None
+        try:
+            stats = json.loads(m[pos[0]:pos[0] + header["stats_len"]], object_pairs_hook=collections.OrderedDict)
+        except ValueError:
+            return None
+        rpref, hpref = unflatten(roffsets, rprefs), unflatten(hoffsets, hprefs)
+        return hrc_instance.Instance.from_prefs(nres, nhosp, header["ncoup"], header["npost"],
+                rpref, hpref, hosp_cap, max_bp, presolve, encoding, header["initial_num_prefs"], stats)
+
+    def put(self, data, instance):
+        "Add instance, which was read from data and presolved if instance.use_presolve, to the cache"
+        filename = self.filename(data, instance.max_bp, instance.use_presolve)
+        roffsets, rprefs = flatten(instance.rpref)
+        hoffsets, hprefs = flatten(instance.hpref)
+        stats = json.dumps(instance.presolve_stats)
+        header = dict(magic=MAGIC, version=VERSION, nres=instance.nres, nhosp=instance.nhosp,
+                      ncoup=instance.ncoup, npost=instance.npost, initial_num_prefs=instance.initial_num_prefs,
+                      num_rprefs=len(rprefs), num_hprefs=len(hprefs), stats_len=len(stats))
+        fd, tmp_filename = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+        with os.fdopen(fd, "wb") as f:
+            for a in [array('i', [header[field] for field in HEADER]), array('i', instance.hosp_cap),
+                      roffsets, rprefs, hoffsets, hprefs]:
+                a.tofile(f)
+            f.write(stats)
+        os.rename(tmp_filename, filename)   # so that readers never see a partly written entry
+        self.evict()
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for filename in glob.glob(os.path.join(self.cache_dir, "*.hrc")):
+            try:
+                st = os.stat(filename)
+                if now - st.st_mtime > self.max_age:
+                    os.remove(filename)
+                else:
+                    entries.append((st.st_mtime, st.st_size, filename))
+            except OSError:
+                pass   # removed by another process
+        total = sum(size for mtime, size, filename in entries)
+        for mtime, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
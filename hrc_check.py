@@ -0,0 +1,178 @@
+import bisect
+import collections
+import re
+
+BP_TYPES = ["type1", "type2", "type3a", "type3bcd"]
+
+RPLACE_NAME = re.compile(r"res(\d+)-(\d+)$")
+
+def assignment_from_var_names(instance, names):
+    """Returns the hospital assigned to each resident (None if unassigned) by a solution
+       given as the names of the variables that take the value 1. Names of rplace variables
+       ("res{}-{}") give a position in a resident's list in instance, which must be the
+       instance that the model was built from (after presolve, if the model was presolved);
+       other names are ignored.
+    """
+    res_hosp = [None] * instance.nres
+    for name in names:
+        m = RPLACE_NAME.match(name)
+        if m is None:
+            continue
+        r, pos = int(m.group(1)), int(m.group(2))
+        res_hosp[r] = instance.rpref[r][pos]
+        if not instance.is_single(r):
+            res_hosp[r+1] = instance.rpref[r+1][pos]
+    return res_hosp
+
+def assignment_from_pairs(nres, lines):
+    """Returns the hospital assigned to each resident from lines of the form "resident hospital".
+       Residents that aren't listed are unassigned.
+    """
+    res_hosp = [None] * nres
+    for line in lines:
+        r, h = [int(x) for x in line.split()]
+        res_hosp[r] = h
+    return res_hosp
+
+class StabilityChecker(object):
+    """Checks assignments of residents to hospitals against an instance, which should not
+       have been presolved, and counts their blocking pairs by type. The blocking pairs are
+       those of the PB model: a pair that the model counts as blocking is counted here.
+
+       Each hospital's assignees are kept as a sorted list of their positions in its
+       preference list, so checking an assignment takes time roughly linear in the total
+       length of the preference lists.
+    """
+    def __init__(self, instance):
+        self.instance = instance
+
+    def check(self, res_hosp, list_pairs=False):
+        """Check the assignment res_hosp (the hospital assigned to each resident, or None).
+           Returns an OrderedDict with "valid", a list of "errors" if it isn't a matching,
+           and, for a matching, the number of "blocking_pairs" of each type, their "total"
+           and, if list_pairs is True, the "pairs" as (type, resident, rank) triples.
+           (For a couple's type 3 pair, resident is the couple's first member.)
+        """
+        inst = self.instance
+        result = collections.OrderedDict()
+        errors = []
+        self.res_hosp = res_hosp
+        self.rank = self.assigned_ranks(res_hosp, errors)
+        self.hosp_positions = [[] for h in range(inst.nhosp)]
+        for r, h in enumerate(res_hosp):
+            if h is not None and self.rank[r] is not None:
+                self.hosp_positions[h].append(inst.hrank(h, r))
+        for h, positions in enumerate(self.hosp_positions):
+            positions.sort()
+            if len(positions) > inst.hosp_cap[h]:
+                errors.append("hospital {} has {} residents but capacity {}".format(
+                        h, len(positions), inst.hosp_cap[h]))
+        result["valid"] = not errors
+        result["errors"] = errors
+        if errors:
+            return result
+
+        self.pairs = []
+        for i in inst.singles:
+            self.find_type1(i)
+        for i, j in inst.couples:
+            self.find_type2(i, j)
+            self.find_type2(j, i)
+            self.find_type3(i, j)
+        counts = collections.Counter(t for t, r, j in self.pairs)
+        result["blocking_pairs"] = collections.OrderedDict((t, counts[t]) for t in BP_TYPES)
+        result["total"] = len(self.pairs)
+        if list_pairs:
+            result["pairs"] = self.pairs
+        del self.res_hosp, self.rank, self.hosp_positions, self.pairs
+        return result
+
+    def assigned_ranks(self, res_hosp, errors):
+        """Returns the rank at which each resident is assigned (a couple's rank in its joint list),
+           or None if unassigned, adding any reason that res_hosp isn't a matching to errors
+        """
+        inst = self.instance
+        if len(res_hosp) != inst.nres:
+            errors.append("assignment has {} residents but instance has {}".format(len(res_hosp), inst.nres))
+            return [None] * inst.nres
+        rank = [None] * inst.nres
+        for r in inst.singles:
+            h = res_hosp[r]
+            if h is None:
+                continue
+            if h not in inst.rpos[r] or r not in inst.hpos[h]:
+                errors.append("resident {} and hospital {} don't rank each other".format(r, h))
+            else:
+                rank[r] = inst.rrank(r, h)[0]
+        for i, p in inst.couples:
+            h, h2 = res_hosp[i], res_hosp[p]
+            if h is None and h2 is None:
+                continue
+            for idx in inst.rrank(i, h):
+                if inst.rpref[p][idx] == h2:
+                    break
+            else:
+                errors.append("couple ({}, {}) doesn't rank hospitals ({}, {})".format(i, p, h, h2))
+                continue
+            if i not in inst.hpos[h] or p not in inst.hpos[h2]:
+                errors.append("hospitals ({}, {}) don't rank couple ({}, {})".format(h, h2, i, p))
+            else:
+                rank[i] = rank[p] = idx
+        return rank
+
+    def num_assigned_up_to(self, h, pos):
+        "The number of residents assigned to h in positions <= pos of h's preference list"
+        return bisect.bisect_right(self.hosp_positions[h], pos)
+
+    def has_space(self, h, n_res, pos):
+        "Does h have fewer than n_res residents assigned in positions <= pos?"
+        return self.num_assigned_up_to(h, pos) < n_res
+
+    def find_type1(self, i):
+        "Single i and a hospital h that i prefers to its assignment, and that has space for i"
+        inst = self.instance
+        a = self.rank[i]
+        for j in range(len(inst.rpref[i]) if a is None else a):
+            h = inst.rpref[i][j]
+            if self.has_space(h, inst.hosp_cap[h], inst.hrank(h, i)):
+                self.pairs.append(("type1", i, j))
+
+    def find_type2(self, i, partner):
+        """Couple member i and a hospital h that i prefers, with the partner keeping its hospital,
+           where h has space for i (if the partner is also at h, and h prefers i, the partner
+           doesn't take up a place)
+        """
+        inst = self.instance
+        a = self.rank[i]
+        if a is None:
+            return
+        for j in range(a):
+            if inst.rpref[partner][j] != inst.rpref[partner][a]:
+                continue
+            h = inst.rpref[i][j]
+            hrank_of_res = inst.hrank(h, i)
+            n = self.num_assigned_up_to(h, hrank_of_res)
+            hrank_of_partner = inst.hpos[h].get(partner)
+            if hrank_of_partner is not None and hrank_of_partner > hrank_of_res and self.res_hosp[partner] == h:
+                n += 1
+            if n < inst.hosp_cap[h]:
+                self.pairs.append(("type2", i, j))
+
+    def find_type3(self, i, partner):
+        "Couple (i, partner) and a pair of hospitals they prefer, with space for both of them"
+        inst = self.instance
+        a = self.rank[i]
+        for j in range(len(inst.rpref[i]) if a is None else a):
+            h, h2 = inst.rpref[i][j], inst.rpref[partner][j]
+            if a is not None and (inst.rpref[i][a] == h or inst.rpref[partner][a] == h2):
+                continue
+            hrank_of_res, hrank_of_partner = inst.hrank(h, i), inst.hrank(h2, partner)
+            if h != h2:
+                if (self.has_space(h, inst.hosp_cap[h], hrank_of_res) and
+                        self.has_space(h2, inst.hosp_cap[h2], hrank_of_partner)):
+                    self.pairs.append(("type3a", i, j))
+            else:
+                first, second = sorted([hrank_of_res, hrank_of_partner])
+                if (self.has_space(h, inst.hosp_cap[h] - 1, first) and
+                        self.has_space(h, inst.hosp_cap[h], second)):
+                    self.pairs.append(("type3bcd", i, j))
@@ -0,0 +1,76 @@
+import random
+
+CAP_DISTS = ["uniform", "geometric"]
+
+def scored_order(items, master_score, correlation, rnd):
+    """Returns items ordered by a mix of a master list and independent random scores.
+       correlation 1 gives the master list order for everyone, 0 gives independent random orders.
+    """
+    scores = {x: correlation * master_score[x] + (1 - correlation) * rnd.random() for x in items}
+    return sorted(items, key=lambda x: scores[x])
+
+def capacities(nhosp, cap_min, cap_max, cap_dist, rnd):
+    """Returns a capacity for each hospital. With cap_dist "uniform" each capacity is uniform in
+       [cap_min, cap_max]; with "geometric" each capacity above cap_min is half as likely
+       as the one below it (up to cap_max), so most hospitals are small.
+    """
+    if cap_dist == "uniform":
+        return [rnd.randint(cap_min, cap_max) for h in range(nhosp)]
+    caps = []
+    for h in range(nhosp):
+        k = 1
+        while k < cap_max - cap_min + 1 and rnd.random() < 0.5:
+            k += 1
+        caps.append(cap_min + k - 1)
+    return caps
+
+def joint_prefs(prefs1, prefs2, length, rnd):
+    """Returns a couple's joint preference list of pairs of hospitals, built from the members'
+       individual lists by taking the pairs with the smallest sum of ranks first.
+    """
+    pairs = [(i + j, rnd.random(), h1, h2) for i, h1 in enumerate(prefs1) for j, h2 in enumerate(prefs2)]
+    pairs.sort()
+    return [(h1, h2) for _, _, h1, h2 in pairs[:length]]
+
+def generate(nres, nhosp, ncoup, seed=0, pref_len=(5, 5), cap_min=1, cap_max=3, cap_dist="uniform",
+             res_correlation=0.0, hosp_correlation=0.0):
+    """Generate a random HRC instance, returned as a list of lines in the format read by
+       hrc_reader.read_instance. Residents 2k and 2k+1, for k < ncoup, are couples.
+       Each preference list length is uniform in the range pref_len (a couple's joint list
+       is a list of pairs). res_correlation and hosp_correlation, between 0 and 1,
+       control how closely the residents' and hospitals' preferences follow a master list.
+       The same arguments always give the same instance.
+    """
+    if 2 * ncoup > nres:
+        raise ValueError("{} couples need at least {} residents".format(ncoup, 2 * ncoup))
+    if cap_dist not in CAP_DISTS:
+        raise ValueError("Unknown capacity distribution {}".format(cap_dist))
+    rnd = random.Random(seed)
+    hosp_score = [rnd.random() for h in range(nhosp)]
+    res_score = [rnd.random() for r in range(nres)]
+    hospitals = range(nhosp)
+
+    def individual_prefs(length):
+        return scored_order(rnd.sample(hospitals, min(length, nhosp)), hosp_score, res_correlation, rnd)
+
+    rpref = []
+    for k in range(ncoup):
+        length = rnd.randint(*pref_len)
+        pairs = joint_prefs(individual_prefs(length), individual_prefs(length), length, rnd)
+        rpref.append([h1 for h1, h2 in pairs])
+        rpref.append([h2 for h1, h2 in pairs])
+    for r in range(2 * ncoup, nres):
+        rpref.append(individual_prefs(rnd.randint(*pref_len)))
+
+    # Each hospital ranks the residents who find it acceptable
+    applicants = [set() for h in range(nhosp)]
+    for r, prefs in enumerate(rpref):
+        for h in prefs:
+            applicants[h].add(r)
+    hpref = [scored_order(sorted(applicants[h]), res_score, hosp_correlation, rnd) for h in hospitals]
+    hosp_cap = capacities(nhosp, cap_min, cap_max, cap_dist, rnd)
+
+    lines = [str(nres), str(nhosp), str(ncoup), str(sum(hosp_cap))] + ["0"] * 5
+    lines.extend(" ".join(str(x) for x in [r] + prefs) for r, prefs in enumerate(rpref))
+    lines.extend(" ".join(str(x) for x in [h, hosp_cap[h]] + prefs) for h, prefs in enumerate(hpref))
+    return lines
@@ -0,0 +1,153 @@
+import bisect
+import collections
+import random
+import time
+
+from hrc_check import StabilityChecker
+
+def deferred_acceptance(instance):
+    """Resident-proposing deferred acceptance, adapted for couples. Returns the hospital
+       assigned to each resident (None if unassigned).
+
+       Each single, and each couple, proposes down its list. A hospital holds the best
+       proposals up to its capacity. A couple's proposal to a pair of hospitals is held
+       only if both hospitals hold it, and when either member is displaced, the
+       couple withdraws the other member and proposes again. Every proposal moves a unit
+       one place down its list, so this takes time linear in the total length of the lists,
+       but with couples the result needn't be stable.
+    """
+    inst = instance
+    res_hosp = [None] * inst.nres
+    held = [[] for h in range(inst.nhosp)]   # (rank in h's list, resident), sorted
+    next_idx = [0] * inst.nres
+    queue = collections.deque([i for i, j in inst.couples] + list(inst.singles))
+
+    def release(r):
+        "Withdraw r, and r's partner if r is in a couple, and queue r's unit to propose again"
+        unit = r if inst.is_single(r) or r % 2 == 0 else r - 1
+        for res in [unit] if inst.is_single(unit) else [unit, unit + 1]:
+            h = res_hosp[res]
+            if h is not None:
+                entry = (inst.hpos[h][res], res)
+                k = bisect.bisect_left(held[h], entry)
+                if k < len(held[h]) and held[h][k] == entry:
+                    del held[h][k]
+                res_hosp[res] = None
+        queue.append(unit)
+
+    def hold(h, r, rank):
+        "Have h hold r, displacing h's worst held resident if h is full"
+        bisect.insort(held[h], (rank, r))
+        res_hosp[r] = h
+        if len(held[h]) > inst.hosp_cap[h]:
+            release(held[h][-1][1])
+
+    def accepts(h, ranks):
+        "Would h hold residents with these ranks, if they proposed together?"
+        if len(ranks) > inst.hosp_cap[h]:
+            return False
+        kept = sorted([rank for rank, r in held[h]] + ranks)[:inst.hosp_cap[h]]
+        return all(rank in kept for rank in ranks)
+
+    while queue:
+        u = queue.popleft()
+        prefs = inst.rpref[u]
+        while next_idx[u] < len(prefs):
+            j = next_idx[u]
+            next_idx[u] += 1
+            if inst.is_single(u):
+                h = prefs[j]
+                rank = inst.hpos[h].get(u)
+                if rank is not None and accepts(h, [rank]):
+                    hold(h, u, rank)
+                    break
+            else:
+                p = u + 1
+                h, h2 = prefs[j], inst.rpref[p][j]
+                rank, rank2 = inst.hpos[h].get(u), inst.hpos[h2].get(p)
+                if rank is None or rank2 is None:
+                    continue
+                if h == h2:
+                    ok = accepts(h, [rank, rank2])
+                else:
+                    ok = accepts(h, [rank]) and accepts(h2, [rank2])
+                if ok:
+                    next_idx[p] = next_idx[u]
+                    hold(h, u, rank)
+                    hold(h2, p, rank2)
+                    break
+    return res_hosp
+
+def satisfy_blocking_pair(instance, res_hosp, pair):
+    """Returns a copy of res_hosp in which the resident or couple of the blocking pair
+       (type, resident, rank), as listed by StabilityChecker, moves to the hospitals at
+       that rank. Residents displaced from a full hospital (worst ranked first) become
+       unassigned, along with their partners.
+    """
+    inst = instance
+    bp_type, r, j = pair
+    res_hosp = list(res_hosp)
+    if bp_type in ("type1", "type2"):
+        moves = [(r, inst.rpref[r][j])]
+    else:
+        moves = [(r, inst.rpref[r][j]), (r + 1, inst.rpref[r + 1][j])]
+    moved = set([r]) if inst.is_single(r) else set([r, inst.get_partner(r)])
+    for res, h in moves:
+        res_hosp[res] = h
+    for h in set(h for res, h in moves):
+        assignees = sorted((inst.hpos[h][res], res) for res, res_h in enumerate(res_hosp) if res_h == h)
+        excess = len(assignees) - inst.hosp_cap[h]
+        for rank, res in reversed(assignees):
+            if excess <= 0:
+                break
+            if res in moved or res_hosp[res] != h:
+                continue
+            res_hosp[res] = None
+            excess -= 1
+            if not inst.is_single(res):
+                partner = inst.get_partner(res)
+                if res_hosp[partner] == h:
+                    excess -= 1
+                res_hosp[partner] = None
+    return res_hosp
+
+def num_assigned(res_hosp):
+    return sum(h is not None for h in res_hosp)
+
+def local_search(instance, res_hosp, max_evals=1000, time_limit=10.0, seed=0):
+    """Reduce the number of blocking pairs of the matching res_hosp (and, for the same number,
+       increase its size) by repeatedly moving the resident or couple of a blocking pair
+       to the hospitals of that pair, while this improves the matching.
+       instance must not have been presolved.
+       Returns the improved matching and its StabilityChecker result.
+    """
+    checker = StabilityChecker(instance)
+    rnd = random.Random(seed)
+    start = time.time()
+    best = checker.check(res_hosp, list_pairs=True)
+    evals = 1
+    improved = True
+    while improved and best["total"] > 0:
+        improved = False
+        pairs = list(best["pairs"])
+        rnd.shuffle(pairs)
+        for pair in pairs:
+            if evals >= max_evals or time.time() - start > time_limit:
+                return res_hosp, best
+            candidate = satisfy_blocking_pair(instance, res_hosp, pair)
+            result = checker.check(candidate, list_pairs=True)
+            evals += 1
+            if result["valid"] and ((result["total"], -num_assigned(candidate)) <
+                                    (best["total"], -num_assigned(res_hosp))):
+                res_hosp, best = candidate, result
+                improved = True
+                break
+    return res_hosp, best
+
+def find_matching(instance, max_evals=1000, time_limit=10.0, seed=0):
+    """Find a matching with few blocking pairs, by deferred acceptance followed by local search.
+       instance must not have been presolved.
+       Returns (res_hosp, number of blocking pairs).
+    """
+    res_hosp, result = local_search(instance, deferred_acceptance(instance), max_evals, time_limit, seed)
+    return res_hosp, result["total"]
@@ -2,25 +2,152 @@ import sys
 import time
 from pb_model import Constraint
 import collections
+import contextlib
+import itertools
 from pprint import pprint as pp
 
+class RankedList(object):
+    """A list of distinct items that supports removing an item, finding the rank of an item
+       (the number of remaining items before it), and finding the item of a given rank,
+       each in O(log n) time. Removed items are left in place as tombstones, and a Fenwick
+       tree over the positions of the remaining items gives the ranks.
+    """
+    def __init__(self, items):
+        self.items = list(items)
+        self.pos = {x: i for i, x in enumerate(self.items)}
+        self.alive = [True] * len(self.items)
+        self.size = len(self.items)
+        n = len(self.items)
+        tree = [0] * (n + 1)
+        for i in range(1, n + 1):
+            tree[i] += 1
+            parent = i + (i & -i)
+            if parent <= n:
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for x, alive in itertools.izip(self.items, self.alive):
+            if alive:
+                yield x
+
+    def rank(self, x):
+        i = self.pos[x]
+        tree = self.tree
+        rank = 0
+        while i > 0:
+            rank += tree[i]
+            i -= i & -i
+        return rank
+
+    def remove(self, x):
+        i = self.pos.pop(x)
+        self.alive[i] = False
+        self.size -= 1
+        tree = self.tree
+        n = len(self.items)
+        i += 1
+        while i <= n:
+            tree[i] -= 1
+            i += i & -i
+
+    def kth(self, k):
+        "The item of rank k"
+        tree = self.tree
+        n = len(self.items)
+        i = 0
+        bit = 1
+        while bit * 2 <= n:
+            bit *= 2
+        while bit:
+            if i + bit <= n and tree[i + bit] <= k:
+                i += bit
+                k -= tree[i]
+            bit //= 2
+        return self.items[i]
+
+    def items_after(self, k):
+        "The remaining items with rank greater than k, as a list"
+        start = self.pos[self.kth(k)] + 1
+        return [x for x, alive in itertools.izip(self.items[start:], self.alive[start:]) if alive]
+
+def format_stats(stats, prefix=""):
+    "Flatten nested stats dicts to a list of 'path: value' lines"
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            lines.extend(format_stats(value, prefix + key + "."))
+        elif isinstance(value, float):
+            lines.append("{}{}: {:.3f}".format(prefix, key, value))
+        else:
+            lines.append("{}{}: {}".format(prefix, key, value))
+    return lines
+
+def read_instance_lines(f):
+    "Read the non-blank lines of file object f (e.g. a pairs file), stripped of whitespace"
+    return [line.strip() for line in f if line.strip()]
+
 class Instance(object):
-    def __init__(self, lines, pb_model, max_bp, presolve=True):
-        self.pb_model = pb_model
+    def __init__(self, data, pb_model, max_bp, presolve=True, encoding="direct"):
+        """data is the instance file's contents, as read by hrc_reader.read_instance.
+           encoding is "direct" or "counter"; see enforce_hosp_space_var.
+           If pb_model is None, the instance is read and presolved, but no model is built;
+           call build_model to build one. If max_bp is None, the instance isn't presolved
+           until max_bp is set by tighten_max_bp; this allows a heuristic (see hrc_heuristic)
+           to choose max_bp using the original preference lists.
+        """
         self.max_bp = max_bp   # Maximum permitted number of blocking pairs
+        self.use_presolve = presolve
+        self.encoding = encoding
+        self.presolve_stats = None
+        self.timings = collections.OrderedDict()   # Wall time in seconds of each phase; see timed
+
+        self.timings["parse"] = data.parse_time
+        with self.timed("read"):
+            self.read_data(data)
+        if presolve and max_bp is not None:
+            with self.timed("presolve"):
+                self.presolve()
+
+        if pb_model is not None:
+            self.build_model(pb_model)
+
+    def tighten_max_bp(self, max_bp):
+        """Reduce the maximum permitted number of blocking pairs to max_bp, before building
+           a new model. Presolving with a smaller bound only removes more preferences, so
+           presolve continues from the lists already trimmed for the larger bound.
+        """
+        if self.max_bp is not None and max_bp > self.max_bp:
+            raise ValueError("max_bp can only be reduced ({} > {})".format(max_bp, self.max_bp))
+        self.max_bp = max_bp
+        if self.use_presolve:
+            with self.timed("presolve"):
+                self.presolve()
+
+    def build_model(self, pb_model):
+        "Build the PB model of the instance, with its current preference lists and max_bp, in pb_model"
+        self.pb_model = pb_model
+        for phase in ["base_model", "type1", "type2", "type3", "write"]:
+            self.timings.pop(phase, None)
+        with self.timed("base_model"):
+            self.add_base_model()
+
+        self.add_stability()
 
-        self.read_lines(lines)
-        if presolve:
-            self.presolve()
+    def add_base_model(self):
+        "Add the assignment variables and the constraints that make them a matching"
 
         # self.rplace[i][j]==1 <-> resident i gets his j^th choice
         # self.r_unassigned[i]==1 <-> resident i is not assigned to a hospital
         self.rplace = [None] * self.nres
         self.r_unassigned = [None] * self.nres
         for i in [c[0] for c in self.couples] + self.singles:
-            self.rplace[i] = [self.pb_model.create_var("res{}-{}".format(i, j))
+            self.rplace[i] = [self.pb_model.create_var("res{}-{}", i, j)
                                     for j in range(len(self.rpref[i]))]
-            self.r_unassigned[i] = self.pb_model.create_var("res{}_unassigned".format(i))
+            self.r_unassigned[i] = self.pb_model.create_var("res{}_unassigned", i)
             self.pb_model.add_exactly_one_constr(self.rplace[i] + [self.r_unassigned[i]],
                     "Resident assigned exactly once, or unassigned")
 
@@ -30,205 +157,497 @@ class Instance(object):
             self.r_unassigned[j] = self.r_unassigned[i]
 
         # self.hplace[i][j]==1 <-> hospital i gets its j^th choice
+        # Where that is equivalent to one of the resident's rplace vars (see hplace_alias_rank),
+        # the rplace var is used as an alias
         self.hplace = []
         for i in range(self.nhosp):
-            self.hplace.append([self.pb_model.create_var("hosp{}-{}".format(i, j))
-                                    for j in range(len(self.hpref[i]))])
+            self.hplace.append([])
+            for j, res in enumerate(self.hpref[i]):
+                k = self.hplace_alias_rank(res, i)
+                if k is None:
+                    self.hplace[i].append(self.pb_model.create_var("hosp{}-{}", i, j))
+                else:
+                    self.hplace[i].append(self.pb_model.create_alias(self.rplace[res][k], "hosp{}-{}", i, j))
             if len(self.hpref[i]) > self.hosp_cap[i]:  # If hospital has more prefs than capacity
                 self.pb_model.add_sum_leq_constr(self.hplace[-1], self.hosp_cap[i],
                         "Hospital capacity")
 
         # Chosen hosp prefs match chosen res prefs
-        # TODO: re-use res pref vars in hospital lists for single residents
         for i, prefs in enumerate(self.hpref):
             for pos, res in enumerate(prefs):
-                self.pb_model.add_constr(
-                        Constraint([(1, self.hplace[i][pos])] +
-                                   [(-1, self.rplace[res][k]) for k in self.rrank(res, i)],
-                                   "=", 0, "Hosp pref matches res prefs"))
-
-        # Add stability
+                if self.hplace_alias_rank(res, i) is None:
+                    self.pb_model.add_constr(
+                            Constraint([(1, self.hplace[i][pos])] +
+                                       [(-1, self.rplace[res][k]) for k in self.rrank(res, i)],
+                                       "=", 0, "Hosp pref matches res prefs"))
+
+    def hplace_alias_rank(self, r, h):
+        """If resident r gets hospital h in exactly one position of its list, and (for a member
+           of a couple) its partner doesn't also get h in that position, returns the position;
+           otherwise None. r's rplace var for the position is then equal to h's hplace var for r,
+           and can be used for it; a hospital's vars are then still distinct.
+        """
+        ranks = self.rrank(r, h)
+        if len(ranks) != 1:
+            return None
+        if not self.is_single(r) and self.rpref[self.get_partner(r)][ranks[0]] == h:
+            return None
+        return ranks[0]
+
+    def add_stability(self):
+        "Add the stability constraints, the blocking pair bound and the objective"
         self.bp_vars = []   # Blocking pair vars
 
-        for i in self.singles:
-            self.add_type1(i)
+        # Hosp-has-space indicator vars, keyed on (hospital, n_res, up_to_pos); see hosp_space_var
+        self.hosp_space_vars = {}
+        self.hosp_space_vars_reused = 0
 
-        for i, j in self.couples:
-            self.add_type2(i, j)
-            self.add_type2(j, i)
-            self.add_type3(i, j)
+        # For the counter encoding, self.hosp_counters[h][pos][k-1] can only take the value 1
+        # if at least k residents are assigned to h in positions <= pos; see hosp_count_var
+        self.hosp_counters = [[] for h in range(self.nhosp)]
+        # Number of terms in hosp-has-space constraints, and the number that the direct encoding would need
+        self.space_terms = 0
+        self.space_terms_direct = 0
+
+        with self.timed("type1"):
+            for i in self.singles:
+                self.add_type1(i)
+
+        with self.timed("type2"):
+            for i, j in self.couples:
+                self.add_type2(i, j)
+                self.add_type2(j, i)
+
+        with self.timed("type3"):
+            for i, j in self.couples:
+                self.add_type3(i, j)
 
         self.pb_model.add_sum_leq_constr(self.bp_vars, self.max_bp, "Max permitted number of blocking pairs")
+        self.pb_model.set_penalty_vars(self.bp_vars)
 
         # Add objective: two points for each matched couple and one point for each matched single
         obj_terms = ([(2, v) for i,_ in self.couples for v in self.rplace[i]] +
                      [(1, v) for i in self.singles for v in self.rplace[i]])
         self.pb_model.add_objective(obj_terms)
 
-    def read_lines(self, lines):
-        self.nres = int(lines[0])
-        self.nhosp = int(lines[1])
-        self.ncoup = int(lines[2])
+        if self.presolve_stats is not None:
+            self.pb_model.add_comment("Presolve: {res_visits} resident visits, {hosp_visits} hospital visits, "
+                    "{res_trims} resident trims removing {res_trim_prefs_removed} resident prefs, "
+                    "{hosp_truncations} hospital truncations removing {hosp_truncation_prefs_removed} "
+                    "resident prefs, {hosp_prefs_removed} hospital prefs removed".format(
+                            **self.presolve_stats))
+        num_aliases = len(self.pb_model.alias_vars)
+        self.pb_model.add_comment("Hosp pref vars aliased to res pref vars: {} variables and {} constraints "
+                "removed".format(num_aliases, num_aliases))
+        self.pb_model.add_comment("Hosp has space vars: {} created, {} duplicates avoided".format(
+                len(self.hosp_space_vars), self.hosp_space_vars_reused))
+        num_terms = self.pb_model.num_terms()
+        self.pb_model.add_comment("Hosp space encoding: {}; {} terms in model, {} with direct encoding".format(
+                self.encoding, num_terms, num_terms - self.space_terms + self.space_terms_direct))
+
+    @classmethod
+    def from_prefs(cls, nres, nhosp, ncoup, npost, rpref, hpref, hosp_cap, max_bp, presolve=True,
+                   encoding="direct", initial_num_prefs=None, presolve_stats=None):
+        """Create an instance, without a model, from preference lists that have already been read
+           (and, if presolve_stats is given, presolved for max_bp), as saved by hrc_cache
+        """
+        self = cls.__new__(cls)
+        self.max_bp = max_bp
+        self.use_presolve = presolve
+        self.encoding = encoding
+        self.presolve_stats = presolve_stats
+        self.timings = collections.OrderedDict()
+        self.set_prefs(nres, nhosp, ncoup, npost, rpref, hpref, hosp_cap)
+        if initial_num_prefs is not None:
+            self.initial_num_prefs = initial_num_prefs
+        return self
+
+    def copy(self):
+        "Returns a copy of the instance's preference lists and settings, without its model"
+        return Instance.from_prefs(self.nres, self.nhosp, self.ncoup, self.npost,
+                [list(prefs) for prefs in self.rpref], [list(prefs) for prefs in self.hpref],
+                list(self.hosp_cap), self.max_bp, self.use_presolve, self.encoding, self.initial_num_prefs,
+                None if self.presolve_stats is None else collections.OrderedDict(self.presolve_stats))
+
+    def components(self):
+        """Returns the connected components of the graph whose edges are the residents'
+           preferences, with the two members of each couple joined, as a list of
+           (residents, hospitals) pairs of sorted lists, ordered by first resident.
+           Hospitals that no resident finds acceptable are in no component.
+
+           A blocking pair only involves a resident and hospitals on its list, so residents
+           in different components can't form blocking pairs with each other's hospitals,
+           and each component can be solved on its own.
+        """
+        parent = range(self.nres + self.nhosp)   # hospital h is node nres + h
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+        def union(x, y):
+            x, y = find(x), find(y)
+            if x != y:
+                parent[max(x, y)] = min(x, y)
+        for i, j in self.couples:
+            union(i, j)
+        for r in range(self.nres):
+            for h in self.rpref[r]:
+                union(r, self.nres + h)
+        members = collections.OrderedDict()
+        for x in range(self.nres + self.nhosp):
+            members.setdefault(find(x), []).append(x)
+        return [([x for x in nodes if x < self.nres], [x - self.nres for x in nodes if x >= self.nres])
+                for root, nodes in members.items() if root < self.nres]
+
+    def subinstance(self, residents, hospitals):
+        """Returns (instance, res_ids, hosp_ids): the instance restricted to a component (see
+           components), without a model, and the original ids of its residents and hospitals.
+           Couples are renumbered first, as the input format requires.
+        """
+        couples = [r for r in residents if not self.is_single(r) and r % 2 == 0]
+        res_ids = [r for i in couples for r in (i, i + 1)] + [r for r in residents if self.is_single(r)]
+        new_res = {r: k for k, r in enumerate(res_ids)}
+        new_hosp = {h: k for k, h in enumerate(hospitals)}
+        hosp_cap = [self.hosp_cap[h] for h in hospitals]
+        instance = Instance.from_prefs(len(res_ids), len(hospitals), len(couples), sum(hosp_cap),
+                [[new_hosp[h] for h in self.rpref[r]] for r in res_ids],
+                [[new_res[r] for r in self.hpref[h]] for h in hospitals],
+                hosp_cap, self.max_bp, self.use_presolve, self.encoding)
+        return instance, res_ids, list(hospitals)
+
+    def read_data(self, data):
+        # Pref list for each resident, after its id
+        rpref = [data.row(r, 1) for r in range(data.nres)]
+
+        # Pref list for each hospital, after its id and capacity
+        hrows = range(data.nres, data.nres + data.nhosp)
+        hpref = [data.row(k, 2) for k in hrows]
+
+        # Hospital capacities
+        hosp_cap = [data.ints[data.starts[k] + 1] for k in hrows]
+
+        self.set_prefs(data.nres, data.nhosp, data.ncoup, data.npost, rpref, hpref, hosp_cap)
+
+    def set_prefs(self, nres, nhosp, ncoup, npost, rpref, hpref, hosp_cap):
+        self.nres = nres
+        self.nhosp = nhosp
+        self.ncoup = ncoup
         self.nsingle = self.nres - 2 * self.ncoup
         self.first_single = 2 * self.ncoup
         self.couples = [(i*2, i*2+1) for i in range(self.ncoup)]
         self.singles = range(self.first_single, self.nres)
-        self.npost = int(lines[3])
-        lines = lines[9:]
+        self.npost = npost
+        self.rpref = rpref
+        self.hpref = hpref
+        self.hosp_cap = hosp_cap
+
+        self.build_rank_index()
+        self.initial_num_prefs = self.num_prefs()
+
+    def num_prefs(self):
+        "The total length of the residents' preference lists"
+        return sum(len(prefs) for prefs in self.rpref)
+
+    def build_rank_index(self):
+        """Build the position maps used by hrank and rrank, so that each rank lookup
+           is constant time. The maps must be kept in sync with rpref and hpref;
+           presolve does this by modifying the lists only through set_rpref and set_hpref.
+        """
+        # self.hpos[h][r] is the position of resident r in h's preference list
+        self.hpos = [None] * self.nhosp
+        # self.rpos[r][h] is the list of positions of hospital h in r's preference list
+        self.rpos = [None] * self.nres
+        for h in range(self.nhosp):
+            self.index_hpref(h)
+        for r in range(self.nres):
+            self.index_rpref(r)
 
-        # Pref list for each resident
-        self.rpref = [[int(x) for x in line.split()[1:]] for line in lines[:self.nres]]
-        
-        # Pref list for each hospital
-        self.hpref = [[int(x) for x in line.split()[2:]] for line in lines[self.nres:self.nres+self.nhosp]]
+    def index_hpref(self, h):
+        self.hpos[h] = {r: pos for pos, r in enumerate(self.hpref[h])}
 
-        # Hospital capacities
-        self.hosp_cap = [int(line.split()[1]) for line in lines[self.nres:self.nres+self.nhosp]]
+    def index_rpref(self, r):
+        positions = {}
+        for pos, h in enumerate(self.rpref[r]):
+            positions.setdefault(h, []).append(pos)
+        self.rpos[r] = positions
+
+    def set_rpref(self, r, prefs):
+        "Replace resident r's preference list, keeping the rank index in sync"
+        self.rpref[r] = prefs
+        self.index_rpref(r)
+
+    def set_hpref(self, h, prefs):
+        "Replace hospital h's preference list, keeping the rank index in sync"
+        self.hpref[h] = prefs
+        self.index_hpref(h)
 
     def presolve(self):
         """Reduce the size of the problem by removing some preferences that,
            if chosen, would result in too many blocking pairs.
-        """
 
-        q = collections.deque()  # Queue of residents to process
-        in_q = [False] * self.nres
+           Two rules are applied until neither removes anything: presolve_trim_res_prefs
+           for each resident (or couple), and presolve_truncate_hosp_prefs for each hospital.
+           Residents and hospitals are kept on work queues, and are only revisited when a
+           removal could change the outcome of the rule for them.
+           During presolve, hospitals' lists are held as RankedLists in self.hlists.
+        """
+        self.hlists = [RankedList(prefs) for prefs in self.hpref]
+        # Preferences removed from residents' lists are counted separately for each rule. Like
+        # the timings, the counts add up over calls, so that after tighten_max_bp they describe
+        # all reductions from the original instance.
+        if self.presolve_stats is None:
+            self.presolve_stats = collections.OrderedDict([
+                    ("res_visits", 0), ("hosp_visits", 0), ("res_trims", 0), ("hosp_truncations", 0),
+                    ("res_trim_prefs_removed", 0), ("hosp_truncation_prefs_removed", 0),
+                    ("hosp_prefs_removed", 0)])
+
+        self.res_q = collections.deque()  # Queue of residents to process
+        self.in_res_q = [False] * self.nres
+        self.hosp_q = collections.deque()  # Queue of hospitals to process
+        self.in_hosp_q = [False] * self.nhosp
         for i in [r1 for r1, r2 in self.couples] + self.singles:
-            q.append(i)
-            in_q[i] = True
-
-        while q:
-            i = q.popleft()
-            in_q[i] = False
-            # num_bp counts the number of pairs that must be blocking pairs
-            # if i doesn't get this or a better choice,
-            # due to the low position of i on the hospital's preference list
-            num_bp = 0
-            if self.is_single(i):
-                for j, hosp in enumerate(self.rpref[i][:-1]):
-                    if self.hrank(hosp, i) < self.hosp_cap[hosp]:
-                        num_bp += 1
-                    if num_bp > self.max_bp:
-                        #print "Cutting down pref list of res {} after pos {}".format(i, j)
-                        self.remove_res_from_hosps(i, self.rpref[i][j+1:], q, in_q)
-                        self.rpref[i] = self.rpref[i][:j+1]  # Trim resident's preferences
-                        break
+            self.queue_res(i)
+        for h in range(self.nhosp):
+            self.queue_hosp(h)
+
+        while self.res_q or self.hosp_q:
+            if self.res_q:
+                i = self.res_q.popleft()
+                self.in_res_q[i] = False
+                self.presolve_stats["res_visits"] += 1
+                self.presolve_trim_res_prefs(i)
             else:
-                for j, (hosp1, hosp2) in enumerate(zip(self.rpref[i][:-1], self.rpref[i+1][:-1])):
-                    hosp1_cap = self.hosp_cap[hosp1]
-                    if self.hrank(hosp1, i) < hosp1_cap:
-                        if hosp1 == hosp2:
-                            if self.hrank(hosp1, i+1) < hosp1_cap:
-                                num_bp += 1
-                        else:
-                            hosp2_cap = self.hosp_cap[hosp2]
-                            if self.hrank(hosp2, i+1) < self.hosp_cap[hosp2]:
-                                num_bp += 1
-
-                    if num_bp > self.max_bp:
-                        # remove residents in this couple from preference lists of hospitals
-                        # where they can no longer appear
-                        for res in [i, i+1]:
-                            # h_remove is the set of hospitals from whose pref lists we can remove resident res
-                            h_remove = set(self.rpref[res])
-                            for hosp in self.rpref[res][:j+1]: h_remove.discard(hosp)
-                            self.remove_res_from_hosps(res, h_remove, q, in_q)
-                            # Trim resident's preferences
-                            self.rpref[res] = self.rpref[res][:j+1] 
-                        break
-
-
-        keep_going = True
-        while keep_going:
-            keep_going = self.presolve_truncate_hosp_prefs()
+                h = self.hosp_q.popleft()
+                self.in_hosp_q[h] = False
+                self.presolve_stats["hosp_visits"] += 1
+                self.presolve_truncate_hosp_prefs(h)
+
+        for h, hlist in enumerate(self.hlists):
+            if len(hlist) < len(self.hpref[h]):
+                self.set_hpref(h, list(hlist))
+        del self.hlists, self.res_q, self.in_res_q, self.hosp_q, self.in_hosp_q
 
 #        pp (self.rpref[:self.first_single])
 #        print
 #        pp (self.rpref[self.first_single:])
 #        sys.exit(1)
-           
-    def presolve_truncate_hosp_prefs(self):
-        """For each hospital h, try to find and remove a suffix of h's pref list that can't be matched.
+
+    def queue_res(self, r):
+        if not self.is_single(r) and r % 2 == 1:
+            r -= 1  # Always add the first member of a couple
+        if not self.in_res_q[r]:
+            self.res_q.append(r)
+            self.in_res_q[r] = True
+
+    def queue_hosp(self, h):
+        if not self.in_hosp_q[h]:
+            self.hosp_q.append(h)
+            self.in_hosp_q[h] = True
+
+    def presolve_trim_res_prefs(self, i):
+        """Trim the preference list of resident i (or of the couple whose first member is i)
+           after the point where not getting this or a better choice would result in too many
+           blocking pairs.
+        """
+        hlists = self.hlists
+        # num_bp counts the number of pairs that must be blocking pairs
+        # if i doesn't get this or a better choice,
+        # due to the low position of i on the hospital's preference list
+        num_bp = 0
+        if self.is_single(i):
+            for j, hosp in enumerate(self.rpref[i][:-1]):
+                if hlists[hosp].rank(i) < self.hosp_cap[hosp]:
+                    num_bp += 1
+                if num_bp > self.max_bp:
+                    #print "Cutting down pref list of res {} after pos {}".format(i, j)
+                    self.presolve_stats["res_trims"] += 1
+                    self.presolve_stats["res_trim_prefs_removed"] += len(self.rpref[i]) - (j+1)
+                    self.remove_res_from_hosps(i, self.rpref[i][j+1:])
+                    self.set_rpref(i, self.rpref[i][:j+1])  # Trim resident's preferences
+                    break
+        else:
+            for j, (hosp1, hosp2) in enumerate(zip(self.rpref[i][:-1], self.rpref[i+1][:-1])):
+                hosp1_cap = self.hosp_cap[hosp1]
+                if hlists[hosp1].rank(i) < hosp1_cap:
+                    if hosp1 == hosp2:
+                        if hlists[hosp1].rank(i+1) < hosp1_cap:
+                            num_bp += 1
+                    else:
+                        if hlists[hosp2].rank(i+1) < self.hosp_cap[hosp2]:
+                            num_bp += 1
+
+                if num_bp > self.max_bp:
+                    self.presolve_stats["res_trims"] += 1
+                    self.presolve_stats["res_trim_prefs_removed"] += 2 * (len(self.rpref[i]) - (j+1))
+                    # remove residents in this couple from preference lists of hospitals
+                    # where they can no longer appear
+                    for res in [i, i+1]:
+                        # h_remove is the set of hospitals from whose pref lists we can remove resident res
+                        h_remove = set(self.rpref[res][j+1:]).difference(self.rpref[res][:j+1])
+                        self.remove_res_from_hosps(res, h_remove)
+                        # Trim resident's preferences
+                        self.set_rpref(res, self.rpref[res][:j+1])
+                    break
+
+    def presolve_truncate_hosp_prefs(self, h):
+        """Try to find and remove a suffix of hospital h's pref list that can't be matched.
 
            For example, suppose we have a hospital with capacity 10, and that max_bp is 1.
            Further, suppose that of the first 14 residents on h's pref list, 11 are such
            that they are single and rank h first. Then, we can safely remove everything after
            the 14th element of h's pref list.
-
-           Returns: whether any preferences were removed
         """
-        truncated = False
-        for h in range(self.nhosp):
-            count = 0  # Number of residents who rank h first
-            for j, r in enumerate(self.hpref[h][:-1]):
-                if self.is_single(r):
-                    if self.rrank(r, h)[0] == 0:
-                        count += 1
-                else:
-                    partner = self.get_partner(r)
-                    #print len(self.rpref[res]), len(self.rpref[partner])
-                    partner_first_pref = self.rpref[partner][0]
-                    if (self.rrank(r, h)[0] == 0 and partner_first_pref != h and
-                            self.hrank(partner_first_pref, partner) < self.hosp_cap[partner_first_pref]):
-                        count += 1
-                if count == self.hosp_cap[h] + self.max_bp:
-                    truncated = True
-                    # residents_to_remove is the set of residents to be removed from the truncated hospital
-                    # pref list. This will consist of partners of people in the truncated part of h's preference
-                    # list such that h only appears in the partner's pref list at a position where the other
-                    # partner also wishes to be assigned to h.
-                    residents_to_remove = set()
-                    for res in self.hpref[h][j+1:]:
-                        if self.is_single(res):
-                            self.rpref[res].remove(h)
-                        else:
-                            to_keep = [idx for idx, hosp in enumerate(self.rpref[res]) if hosp != h]
-                            partner = self.get_partner(res)
-                            hosps = set(self.rpref[partner]) # all hosps on partner's pref list
-                            # all hosps that will remain on partner's pref list
-                            hosps_to_keep = set(hosp for k, hosp in enumerate(self.rpref[partner]) if k in to_keep)
-                            hosps_to_remove = hosps - hosps_to_keep
-                            self.rpref[res] = [self.rpref[res][idx] for idx in to_keep]
-                            self.rpref[partner] = [self.rpref[partner][idx] for idx in to_keep]
-                            for hosp in hosps_to_remove:
-                                if hosp == h:
-                                    if self.hrank(h, partner) < j+1:
-                                        residents_to_remove.add(partner)
-                                else:
-                                    self.hpref[hosp].remove(partner)
-                    self.hpref[h] = self.hpref[h][:j+1]
-                    for res in residents_to_remove:
-                        self.hpref[h].remove(res)
-#                    if X: print " ", self.hpref[h]
-                    break
-        return truncated
-
-    def remove_res_from_hosps(self, res, hosps, q, in_q):
-        """Remove resident res from hospitals in hosps as part of presolve.
-           Residents who move into a hospital's top-k prefs, where k is the
-           hospital's capacity, are added to the queue.
+        hlists = self.hlists
+        hlist = hlists[h]
+        last = len(hlist) - 1
+        count = 0  # Number of residents who rank h first
+        for j, r in enumerate(hlist):
+            if j == last:
+                break
+            if self.is_single(r):
+                if self.rpref[r][0] == h:
+                    count += 1
+            else:
+                partner = self.get_partner(r)
+                partner_first_pref = self.rpref[partner][0]
+                if (self.rpref[r][0] == h and partner_first_pref != h and
+                        hlists[partner_first_pref].rank(partner) < self.hosp_cap[partner_first_pref]):
+                    count += 1
+            if count == self.hosp_cap[h] + self.max_bp:
+                self.presolve_stats["hosp_truncations"] += 1
+                suffix = hlist.items_after(j)
+                # residents_to_remove is the set of residents to be removed from the truncated hospital
+                # pref list. This will consist of partners of people in the truncated part of h's preference
+                # list such that h only appears in the partner's pref list at a position where the other
+                # partner also wishes to be assigned to h.
+                residents_to_remove = set()
+                for res in suffix:
+                    if self.is_single(res):
+                        self.presolve_set_rpref(res, [hosp for hosp in self.rpref[res] if hosp != h])
+                    else:
+                        to_keep = [idx for idx, hosp in enumerate(self.rpref[res]) if hosp != h]
+                        partner = self.get_partner(res)
+                        hosps = set(self.rpref[partner]) # all hosps on partner's pref list
+                        self.presolve_set_rpref(res, [self.rpref[res][idx] for idx in to_keep])
+                        self.presolve_set_rpref(partner, [self.rpref[partner][idx] for idx in to_keep])
+                        # hosps that are no longer on partner's pref list
+                        hosps_to_remove = hosps.difference(self.rpref[partner])
+                        for hosp in hosps_to_remove:
+                            if hosp == h:
+                                if hlist.rank(partner) < j+1:
+                                    residents_to_remove.add(partner)
+                            else:
+                                self.presolve_remove_from_hosp(hosp, partner)
+                for res in suffix:
+                    self.presolve_remove_from_hosp(h, res)
+                for res in residents_to_remove:
+                    self.presolve_remove_from_hosp(h, res)
+                break
+
+    def presolve_set_rpref(self, r, prefs):
+        """Replace resident r's preference list during presolve. If r's first preference changes,
+           hospitals whose truncation rule depends on it are queued.
         """
+        old_first = self.rpref[r][0] if self.rpref[r] else None
+        self.presolve_stats["hosp_truncation_prefs_removed"] += len(self.rpref[r]) - len(prefs)
+        self.set_rpref(r, prefs)
+        if prefs and prefs[0] != old_first:
+            self.queue_hosp(prefs[0])
+            if not self.is_single(r):
+                partner_prefs = self.rpref[self.get_partner(r)]
+                if partner_prefs:
+                    self.queue_hosp(partner_prefs[0])
+
+    def remove_res_from_hosps(self, res, hosps):
+        "Remove resident res from hospitals in hosps as part of presolve."
         for hosp in hosps:
-            self.hpref[hosp].remove(res)
-            if len(self.hpref[hosp]) >= self.hosp_cap[hosp]:
-                r = self.hpref[hosp][self.hosp_cap[hosp] - 1]
-                if not in_q[r]:
-                    if not self.is_single(r) and r % 2 == 1:
-                        r -= 1  # Always add the first member of a couple
-                    q.append(r)
-                    in_q[r] = True
+            self.presolve_remove_from_hosp(hosp, res)
 
-
-    def write(self, quiet):
-        self.pb_model.write(quiet)
+    def presolve_remove_from_hosp(self, h, r):
+        """Remove resident r from hospital h's pref list as part of presolve.
+           A resident who moves into h's top-k prefs, where k is h's capacity, is added
+           to the queue, as is any hospital whose truncation rule can be affected.
+        """
+        hlist = self.hlists[h]
+        rank = hlist.rank(r)
+        hlist.remove(r)
+        self.presolve_stats["hosp_prefs_removed"] += 1
+        self.queue_hosp(h)
+        cap = self.hosp_cap[h]
+        if rank < cap and len(hlist) >= cap:
+            r = hlist.kth(cap - 1)
+            self.queue_res(r)
+            if not self.is_single(r) and self.rpref[r][0] == h:
+                # r's partner may now count as ranking its own first choice first
+                self.queue_hosp(self.rpref[self.get_partner(r)][0])
+
+    def add_hint(self, res_hosp):
+        """Give the solver the matching res_hosp (the hospital of each resident, or None)
+           as a hint, by setting the values of the model's assignment variables.
+           Residents whose hospital has been removed from their lists by presolve are left out.
+        """
+        hinted = [False] * self.nres
+        values = []
+        for i in [r1 for r1, r2 in self.couples] + self.singles:
+            pos = None
+            if res_hosp[i] is not None:
+                pos = next((idx for idx in self.rrank(i, res_hosp[i])
+                            if self.is_single(i) or self.rpref[i+1][idx] == res_hosp[i+1]), None)
+                if pos is None:
+                    continue
+            values.extend((v, int(j == pos)) for j, v in enumerate(self.rplace[i]))
+            values.append((self.r_unassigned[i], int(pos is None)))
+            hinted[i] = True
+            if not self.is_single(i):
+                hinted[i+1] = True
+        for h, prefs in enumerate(self.hpref):
+            values.extend((self.hplace[h][pos], int(res_hosp[r] == h))
+                          for pos, r in enumerate(prefs)
+                          if hinted[r] and self.hplace_alias_rank(r, h) is None)
+        self.pb_model.set_hint(values)
+
+    def write(self, quiet, f=sys.stdout):
+        with self.timed("write"):
+            self.pb_model.write(quiet, f)
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        "Add the wall time of a with-block to self.timings[phase]"
+        start = time.time()
+        yield
+        self.timings[phase] = self.timings.get(phase, 0.0) + time.time() - start
+
+    def stats(self):
+        """Returns the instrumentation for the instance and its model, as nested dicts:
+           phase timings, presolve reductions, and the model's size, including the number of
+           constraints with each name and the number of variables with each name format.
+        """
+        stats = collections.OrderedDict()
+        stats["max_bp"] = self.max_bp
+        stats["timings"] = self.timings
+        stats["presolve"] = self.presolve_stats
+        stats["prefs"] = collections.OrderedDict([
+                ("initial", self.initial_num_prefs), ("final", self.num_prefs())])
+        stats["model"] = self.pb_model.stats()
+        return stats
+
+    def add_stats_comments(self):
+        """Add the instrumentation, up to the point when this is called, to the model's comments.
+           The model is presolved first, if it is to be, so that its size is the size written.
+        """
+        if self.pb_model.use_presolve:
+            with self.timed("model_presolve"):
+                self.pb_model.presolve()
+        for line in format_stats(self.stats()):
+            self.pb_model.add_comment(line)
 
     def add_type1(self, i):
         for j, h in enumerate(self.rpref[i]):
             # If hospital h would like to take resident i, hosp_has_space_var must take the value 1.
             # Otherwise, this variable can take any value.
-            hosp_has_space_var = self.pb_model.create_var("type1_hosp_space-{}-{}-{}".format(i, h, self.hrank(h, i)))
-            self.enforce_hosp_space_var(hosp_has_space_var, h, self.hosp_cap[h], self.hrank(h, i),
-                    "Hosp has space var has correct value (type 1)")
-            var = self.pb_model.create_var("type1-{}-{}".format(i, j))
+            hosp_has_space_var = self.hosp_space_var(h, self.hosp_cap[h], self.hrank(h, i))
+            var = self.pb_model.create_var("type1-{}-{}", i, j)
             self.bp_vars.append(var)
             self.pb_model.add_constr(Constraint([(1, var), (-1, hosp_has_space_var)] +
                                       [(1, v) for v in self.rplace[i][:j+1]], ">=", 0, "Type 1 stability"))
@@ -238,22 +657,18 @@ class Instance(object):
             hrank_of_res = self.hrank(h, i)
             # If hospital h isn't filled to capacity by i's partner and residents preferred to i,
             # then hosp_has_space_var must take the value 1.
-            hosp_has_space_var = self.pb_model.create_var("type2_hosp_space-{}-{}-{}".format(i, h, hrank_of_res))
-            hplace_vars = self.hplace[h][:hrank_of_res + 1]
-            try:
-                hrank_of_partner = self.hrank(h, partner) 
-                if hrank_of_partner > hrank_of_res:
-                    hplace_vars.append(self.hplace[h][hrank_of_partner])
-            except ValueError:
-                pass   # Hospital doesn't rank partner
-            self.pb_model.add_constr(Constraint([(self.hosp_cap[h], hosp_has_space_var)] + 
-                                      [(1, v) for v in hplace_vars],
-                                      ">=", self.hosp_cap[h], "Hosp has space var has correct value (type 2)"))
-            var = self.pb_model.create_var("type2-{}-{}".format(i, j))
+            hosp_has_space_var = self.pb_model.create_var("type2_hosp_space-{}-{}-{}", i, h, hrank_of_res)
+            partner_var = None
+            hrank_of_partner = self.hpos[h].get(partner)   # None if hospital doesn't rank partner
+            if hrank_of_partner is not None and hrank_of_partner > hrank_of_res:
+                partner_var = self.hplace[h][hrank_of_partner]
+            self.enforce_hosp_space_var(hosp_has_space_var, h, self.hosp_cap[h], hrank_of_res,
+                    "Hosp has space var has correct value (type 2)", partner_var)
+            var = self.pb_model.create_var("type2-{}-{}", i, j)
             self.bp_vars.append(var)
             # A list of ranks worse than j for resident i, such that i's partner gets the same hospital as he does at rank j
             worse_ranks_with_same_partner_hosp = [
-                    idx for idx in range(j+1, len(self.rpref[i])) if self.rpref[partner][j]==self.rpref[partner][idx]]
+                    idx for idx in self.rrank(partner, self.rpref[partner][j]) if idx > j]
             self.pb_model.add_constr(Constraint([(1, var), (-1, hosp_has_space_var)] +
                               [(-1, self.rplace[i][idx]) for idx in worse_ranks_with_same_partner_hosp],
                               ">=", -1, "Type 2 stability"))
@@ -270,15 +685,10 @@ class Instance(object):
                 self.add_type3bcd(partner, i, j, h, hrank_of_partner, hrank_of_res)
 
     def add_type3a(self, i, partner, j, h, h2, hrank_of_res, hrank_of_partner):
-        hosp1_has_space_var = self.pb_model.create_var("hosp1_space-{}-{}".format(h, hrank_of_res))
-        self.enforce_hosp_space_var(hosp1_has_space_var, h, self.hosp_cap[h], hrank_of_res,
-                "Hosp 1 has space var has correct value (type 3a)")
+        hosp1_has_space_var = self.hosp_space_var(h, self.hosp_cap[h], hrank_of_res)
+        hosp2_has_space_var = self.hosp_space_var(h2, self.hosp_cap[h2], hrank_of_partner)
 
-        hosp2_has_space_var = self.pb_model.create_var("hosp2_space-{}-{}".format(h2, hrank_of_partner))
-        self.enforce_hosp_space_var(hosp2_has_space_var, h2, self.hosp_cap[h2], hrank_of_partner,
-                "Hosp 2 has space var has correct value (type 3a)")
-
-        var = self.pb_model.create_var("type3a-{}-{}".format(i, j))
+        var = self.pb_model.create_var("type3a-{}-{}", i, j)
         self.bp_vars.append(var)
         self.pb_model.add_constr(Constraint([(1, var), (-1, hosp1_has_space_var), (-1, hosp2_has_space_var)] +
                       [(-1, self.rplace[i][idx]) for idx in range(j+1, len(self.rpref[i]))
@@ -289,35 +699,125 @@ class Instance(object):
     def add_type3bcd(self, i, partner, j, h, hrank_of_res, hrank_of_partner):
         # The hospital should have no more than capacity-2 spaces used up to resident i,
         # and no more than capacity-1 spaces used up to resident partner
-        hosp_has_space_part_1_var = self.pb_model.create_var("hosp(3bcd)_space-{}-{}-part-1".format(h, hrank_of_res))
-        self.enforce_hosp_space_var(hosp_has_space_part_1_var, h, self.hosp_cap[h] - 1, hrank_of_res,
-                "Hosp (3bcd) has space var part 1 has correct value")
-
-        hosp_has_space_part_2_var = self.pb_model.create_var("hosp(3bcd)_space-{}-{}-part-2".format(h, hrank_of_partner))
-        self.enforce_hosp_space_var(hosp_has_space_part_2_var, h, self.hosp_cap[h], hrank_of_partner,
-                "Hosp (3bcd) has space var part 2 has correct value")
+        hosp_has_space_part_1_var = self.hosp_space_var(h, self.hosp_cap[h] - 1, hrank_of_res)
+        hosp_has_space_part_2_var = self.hosp_space_var(h, self.hosp_cap[h], hrank_of_partner)
 
         # If there's space in both hospitals, then hosp_has_space_var must take value 1.
-        hosp_has_space_var = self.pb_model.create_var("hosp(3bcd)_space-{}-{}".format(h, hrank_of_res))
+        hosp_has_space_var = self.pb_model.create_var("hosp(3bcd)_space-{}-{}", h, hrank_of_res)
         self.pb_model.add_constr(Constraint([(1, hosp_has_space_var),
                                              (-1, hosp_has_space_part_1_var),
                                              (-1, hosp_has_space_part_2_var)
                                              ], ">=", -1, "Hospital has space (3bcd)"))
 
-        var = self.pb_model.create_var("type3bcd-{}-{}".format(i, j))
+        var = self.pb_model.create_var("type3bcd-{}-{}", i, j)
         self.bp_vars.append(var)
         self.pb_model.add_constr(Constraint([(1, var), (-1, hosp_has_space_var), (-1, self.r_unassigned[i])] +
                           [(-1, self.rplace[i][idx]) for idx in range(j+1, len(self.rpref[i]))
                                 if h != self.rpref[i][idx] and h != self.rpref[partner][idx]],
                           ">=", -1, "Type 3bcd stability"))
         
-    def enforce_hosp_space_var(self, v, h, n_res, up_to_pos, constraint_name):
+    def hosp_space_var(self, h, n_res, up_to_pos):
+        """Returns a variable that must take the value 1 if hospital h has fewer than n_res residents
+           assigned in positions <= up_to_pos in h's preference list.
+           The variable depends only on (h, n_res, up_to_pos), so it is created once and shared
+           by every stability constraint that needs it.
+        """
+        key = (h, n_res, up_to_pos)
+        v = self.hosp_space_vars.get(key)
+        if v is None:
+            v = self.pb_model.create_var("hosp_space-{}-{}-{}", h, n_res, up_to_pos)
+            self.enforce_hosp_space_var(v, h, n_res, up_to_pos, "Hosp has space var has correct value")
+            self.hosp_space_vars[key] = v
+        else:
+            self.hosp_space_vars_reused += 1
+        return v
+
+    def enforce_hosp_space_var(self, v, h, n_res, up_to_pos, constraint_name, extra_var=None):
         """Enforce the condition that if hospital h has fewer than n_res residents assigned in positions
            <= up_to_pos in h's preference list, then variable v must take the value 1.
            (Otherwise, v can take any value.)
+           If extra_var is given, it is counted as one more assigned resident when it takes the value 1.
+
+           The direct encoding repeats the whole prefix of h's hplace vars in each such constraint.
+           The counter encoding instead refers to a chain of prefix-count variables for h
+           (see hosp_count_var), so that the model size grows linearly in the list length.
         """
-        self.pb_model.add_constr(Constraint(
-                [(n_res, v)] + [(1, var) for var in self.hplace[h][:up_to_pos + 1]], ">=", n_res, constraint_name))
+        hplace_vars = self.hplace[h][:up_to_pos + 1]
+        if extra_var is not None:
+            hplace_vars.append(extra_var)
+        self.space_terms_direct += len(hplace_vars) + 1
+        if self.encoding == "counter":
+            self.enforce_hosp_space_var_counter(v, h, n_res, up_to_pos, constraint_name, extra_var)
+        else:
+            self.add_space_constr([n_res] + [1] * len(hplace_vars), [v] + hplace_vars,
+                    ">=", n_res, constraint_name)
+
+    def enforce_hosp_space_var_counter(self, v, h, n_res, up_to_pos, constraint_name, extra_var):
+        if n_res <= 0:
+            return   # h can never have fewer than n_res residents, so v can take any value
+        count_n = self.hosp_count_var(h, up_to_pos, n_res)
+        if extra_var is None:
+            # v + count_n >= 1
+            coefs, variables = [1], [v]
+            if count_n is not None:
+                coefs.append(1)
+                variables.append(count_n)
+            self.add_space_constr(coefs, variables, ">=", 1, constraint_name)
+        else:
+            # 2 v + 2 count_n + count_(n-1) + extra_var >= 2, where count_0 is always 1
+            coefs, variables = [2, 1], [v, extra_var]
+            rhs = 2
+            if count_n is not None:
+                coefs.append(2)
+                variables.append(count_n)
+            if n_res == 1:
+                rhs -= 1
+            else:
+                count_n_minus_1 = self.hosp_count_var(h, up_to_pos, n_res - 1)
+                if count_n_minus_1 is not None:
+                    coefs.append(1)
+                    variables.append(count_n_minus_1)
+            self.add_space_constr(coefs, variables, ">=", rhs, constraint_name)
+
+    def hosp_count_var(self, h, pos, k):
+        """Returns a variable that can only take the value 1 if at least k residents are assigned
+           to hospital h in positions <= pos of h's preference list, or None if this is impossible.
+           (1 <= k <= hosp_cap[h].) The counter for h is extended as far as pos on demand.
+        """
+        counter = self.hosp_counters[h]
+        while len(counter) <= pos:
+            self.extend_hosp_counter(h)
+        row = counter[pos]
+        return row[k - 1] if k <= len(row) else None
+
+    def extend_hosp_counter(self, h):
+        "Add the prefix-count variables for the next position of hospital h's counter"
+        counter = self.hosp_counters[h]
+        pos = len(counter)
+        x = self.hplace[h][pos]
+        prev_row = counter[-1] if counter else []
+        row = []
+        for k in range(1, min(pos + 1, self.hosp_cap[h]) + 1):
+            v = self.pb_model.create_var("hosp_count-{}-{}-{}", h, pos, k)
+            # At least k residents up to pos only if at least k up to pos-1,
+            # or x and at least k-1 up to pos-1:  2 v <= 2 prev_k + x + prev_(k-1)
+            coefs, variables = [2, -1], [v, x]
+            rhs = 0
+            if k <= len(prev_row):
+                coefs.append(-2)
+                variables.append(prev_row[k - 1])
+            if k == 1:
+                rhs = 1
+            else:
+                coefs.append(-1)
+                variables.append(prev_row[k - 2])
+            self.add_space_constr(coefs, variables, "<=", rhs, "Hosp prefix count")
+            row.append(v)
+        counter.append(row)
+
+    def add_space_constr(self, coefs, variables, comp, rhs, name):
+        self.space_terms += len(variables)
+        self.pb_model.add_linear_constr(coefs, variables, comp, rhs, name)
         
     def is_single(self, res):
         return res >= self.first_single
@@ -330,11 +830,11 @@ class Instance(object):
         """What ranks does resident r give hospital h (as an array)?
            Note that a resident in a couple may rank a hospital more than once
         """
-        return [i for i, hosp in enumerate(self.rpref[r]) if hosp == h]
+        return self.rpos[r].get(h, [])
             
     def hrank(self, h, r):
         "What rank does hospital h give resident r?"
-        return self.hpref[h].index(r)
+        return self.hpos[h][r]
 
     def show_sol(self, filename):
         # TODO: make this less hacky
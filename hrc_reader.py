@@ -0,0 +1,168 @@
+from array import array
+import hashlib
+import json
+import time
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# An instance file has nres, nhosp, ncoup and npost on its first four non-blank lines, and five
+# more lines that are ignored, followed by a line "id prefs..." for each resident and
+# "id capacity prefs..." for each hospital
+HEADER_LINES = 9
+GZIP_MAGIC = "\x1f\x8b"
+CHUNK_SIZE = 1 << 24
+
+class InstanceData(object):
+    """The numbers in an instance file, as read by read_instance. The k-th non-blank line after
+       the header holds ints[starts[k]:starts[k+1]]; resident r's line is line r, and hospital h's
+       is line nres + h; ints and starts are arrays. digest is the SHA-1 hex digest of the
+       (uncompressed) text, for hrc_cache.
+    """
+    def __init__(self, nres, nhosp, ncoup, npost, ints, starts, digest, parse_time=0.0):
+        self.nres = nres
+        self.nhosp = nhosp
+        self.ncoup = ncoup
+        self.npost = npost
+        self.ints = ints
+        self.starts = starts
+        self.digest = digest
+        self.parse_time = parse_time   # Wall time in seconds to read and parse the file
+        if len(starts) - 1 < nres + nhosp:
+            raise ValueError("The instance has {} residents and {} hospitals, but only {} lines after its header"
+                             .format(nres, nhosp, len(starts) - 1))
+        # A resident's line has its id, as blank lines are skipped; a hospital's also needs its capacity
+        for k in range(nres, nres + nhosp):
+            if starts[k+1] - starts[k] < 2:
+                raise ValueError("Line {} (not counting blank lines), for hospital {}, has no capacity"
+                                 .format(HEADER_LINES + k + 1, k - nres))
+
+    def row(self, k, skip=0):
+        "The numbers on the k-th line after the header, as a list, leaving out the first skip"
+        return self.ints[self.starts[k] + skip:self.starts[k+1]].tolist()
+
+def parse_rows(text):
+    """Parse text, a sequence of complete lines of non-negative integers, in bulk. Returns
+       (ints, lengths): the integers, and the number on each non-blank line.
+    """
+    if numpy is not None:
+        # Mark the end of each line with -1, then parse the whole text at once
+        values = numpy.fromstring(text.replace("\n", " -1 "), dtype=numpy.int32, sep=" ")
+        ends = numpy.flatnonzero(values < 0)
+        if len(ends) != text.count("\n"):
+            raise ValueError("Instance lines must hold only non-negative integers")
+        lengths = numpy.diff(numpy.concatenate(([-1], ends))) - 1
+        return values[values >= 0], lengths[lengths > 0]
+    # Without NumPy, the quickest way to parse many ints is as JSON lists, if the text is just
+    # digits separated by single spaces (as hrc-gen.py writes it); otherwise, parse line by line
+    rows = None
+    if not text.translate(None, "0123456789 \n"):
+        try:
+            rows = json.loads("[[" + text[:-1].replace(" ", ",").replace("\n", "],[") + "]]")
+        except ValueError:
+            pass   # e.g. two spaces in a row
+    if rows is None:
+        try:
+            rows = [[int(x) for x in line.split()] for line in text.splitlines()]
+            valid = all(x >= 0 for row in rows for x in row)
+        except ValueError:
+            valid = False
+        if not valid:
+            raise ValueError("Instance lines must hold only non-negative integers")
+    ints, lengths = array('i'), array('l')
+    for row in rows:
+        if row:
+            ints.extend(row)
+            lengths.append(len(row))
+    return ints, lengths
+
+class InstanceParser(object):
+    "Parses the text of an instance, given in pieces of any size, into InstanceData"
+    def __init__(self):
+        self.digest = hashlib.sha1()
+        self.header = []    # The header's non-blank lines
+        self.pending = ""   # The text after the last complete line
+        self.chunks = []    # (ints, lengths) for each parsed piece of the lines after the header
+
+    def feed(self, text):
+        self.digest.update(text)
+        text = self.pending + text
+        end = text.rfind("\n") + 1
+        self.pending = text[end:]
+        self.parse(text[:end])
+
+    def parse(self, text):
+        "Parse complete lines"
+        pos = 0
+        while len(self.header) < HEADER_LINES and pos < len(text):
+            end = text.index("\n", pos) + 1
+            line = text[pos:end].strip()
+            if line:
+                self.header.append(line)
+            pos = end
+        if pos < len(text):
+            self.chunks.append(parse_rows(text[pos:]))
+
+    def finish(self, parse_time=0.0):
+        if self.pending:
+            self.parse(self.pending + "\n")
+            self.pending = ""
+        if len(self.header) < 4:
+            raise ValueError("The instance header is incomplete")
+        nres, nhosp, ncoup, npost = [int(line) for line in self.header[:4]]
+        ints, starts = array('i'), array('l', [0])
+        if numpy is not None:
+            # Slicing arrays is quicker than slicing NumPy arrays, for Instance.read_data
+            for chunk_ints, lengths in self.chunks:
+                ints.fromstring(chunk_ints.astype(numpy.intc).tostring())
+                starts.extend((numpy.cumsum(lengths) + starts[-1]).tolist())
+        else:
+            for chunk_ints, lengths in self.chunks:
+                ints.extend(chunk_ints)
+                for n in lengths:
+                    starts.append(starts[-1] + n)
+        self.chunks = []
+        return InstanceData(nres, nhosp, ncoup, npost, ints, starts, self.digest.hexdigest(), parse_time)
+
+def read_chunks(f, chunk_size=CHUNK_SIZE):
+    "Yields the contents of file object f in chunks, decompressing them if f is gzip-compressed"
+    chunk = f.read(chunk_size)
+    while 0 < len(chunk) < len(GZIP_MAGIC):   # too short to tell
+        more = f.read(chunk_size)
+        if not more:
+            break
+        chunk += more
+    if not chunk.startswith(GZIP_MAGIC):
+        while chunk:
+            yield chunk
+            chunk = f.read(chunk_size)
+        return
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while chunk:
+        yield decompressor.decompress(chunk)
+        while decompressor.unused_data:   # the start of another gzip member
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            yield decompressor.decompress(chunk)
+        chunk = f.read(chunk_size)
+    yield decompressor.flush()
+
+def read_instance(f, chunk_size=CHUNK_SIZE):
+    """Read an instance from file object f, which may be gzip-compressed. The file is read
+       and parsed in chunks of about chunk_size bytes, so that the whole text is never in memory.
+    """
+    start = time.time()
+    parser = InstanceParser()
+    for chunk in read_chunks(f, chunk_size):
+        parser.feed(chunk)
+    return parser.finish(time.time() - start)
+
+def parse_instance(lines):
+    "Parse an instance given as a list of lines, such as hrc_generator.generate returns"
+    start = time.time()
+    parser = InstanceParser()
+    parser.feed("\n".join(lines) + "\n")
+    return parser.finish(time.time() - start)
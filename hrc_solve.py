@@ -0,0 +1,277 @@
+import collections
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+import hrc_check
+from pb_model import PBModel
+
+STATUSES = {"OPTIMUM FOUND": "optimum", "SATISFIABLE": "satisfiable",
+            "UNSATISFIABLE": "unsatisfiable", "UNKNOWN": "unknown"}
+
+def parse_solver_output(lines):
+    """Parse the output of a PB solver in the format of the PB competition.
+       Returns (status, objective, true_vars), where objective is the last "o" value (or None)
+       and true_vars are the indices of the variables that are true in the "v" lines
+       (or None if there are no "v" lines).
+    """
+    status = "unknown"
+    objective = None
+    true_vars = None
+    for line in lines:
+        if line.startswith("s "):
+            status = STATUSES.get(line[2:].strip(), "unknown")
+        elif line.startswith("o "):
+            objective = int(line.split()[1])
+        elif line.startswith("v "):
+            if true_vars is None:
+                true_vars = []
+            true_vars.extend(int(lit[1:]) - 1 for lit in line.split()[1:] if lit.startswith("x"))
+    if status == "unknown" and true_vars is not None:
+        status = "satisfiable"   # e.g. the solver printed its best solution when it was stopped
+    return status, objective, true_vars
+
+class SolverRun(object):
+    """One solver process, solving the model of an instance for one value of max_bp.
+       The model is written to the solver's stdin by one thread while another collects
+       its output, so that neither pipe can fill up and block the solver.
+    """
+    def __init__(self, command, instance, max_bp, timeout):
+        """command is the solver's command line. Any {} in it is replaced by /dev/stdin, for
+           solvers that need a file name; otherwise the model is just given on stdin.
+           instance is copied and presolved for max_bp, so it must not have been presolved
+           for a smaller bound.
+        """
+        self.command = [arg.replace("{}", "/dev/stdin") for arg in shlex.split(command)]
+        self.max_bp = max_bp
+        self.timeout = timeout
+        self.instance = instance.copy()
+        self.instance.tighten_max_bp(max_bp)
+        self.instance.build_model(PBModel("opb", quiet=True))
+        self.output = []
+        self.cancelled = False
+        self.timed_out = False
+
+    def start(self):
+        self.start_time = time.time()
+        with open(os.devnull, "w") as devnull:
+            self.proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=devnull, close_fds=True)
+        self.writer = threading.Thread(target=self.write_model)
+        self.reader = threading.Thread(target=self.read_output)
+        for thread in [self.writer, self.reader]:
+            thread.daemon = True
+            thread.start()
+
+    def write_model(self):
+        try:
+            self.instance.pb_model.write(True, self.proc.stdin)
+            self.proc.stdin.close()
+        except IOError:
+            pass   # the solver stopped before reading the whole model
+
+    def read_output(self):
+        for line in iter(self.proc.stdout.readline, ""):
+            self.output.append(line)
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def poll(self):
+        "Returns True if the solver has finished, stopping it if it has run out of time"
+        if self.timeout is not None and self.elapsed() > self.timeout and self.proc.poll() is None:
+            self.timed_out = True
+            self.stop()
+        if self.proc.poll() is None:
+            return False
+        self.reader.join()
+        self.time = self.elapsed()
+        return True
+
+    def stop(self, grace=1.0):
+        "Ask the solver to stop, so that it can report its best solution, then kill it if it doesn't"
+        try:
+            self.proc.terminate()
+            deadline = time.time() + grace
+            while self.proc.poll() is None and time.time() < deadline:
+                time.sleep(0.01)
+            if self.proc.poll() is None:
+                self.proc.kill()
+                self.proc.wait()
+        except OSError:
+            pass   # the solver has already exited
+
+    def cancel(self):
+        self.cancelled = True
+        self.stop(grace=0.0)
+        self.reader.join()
+        self.time = self.elapsed()
+
+    def result(self):
+        """Returns an OrderedDict describing the run. If the solver found a solution, it is decoded
+           into the hospital assigned to each resident, using the model's variable names.
+        """
+        status, objective, true_vars = parse_solver_output(self.output)
+        if self.cancelled:
+            status = "cancelled"
+        result = collections.OrderedDict([("max_bp", self.max_bp), ("status", status),
+                                          ("objective", objective), ("time", self.time),
+                                          ("timed_out", self.timed_out)])
+        if true_vars is not None and not self.cancelled:
+            var_names = self.instance.pb_model.output_var_names()
+            result["matching"] = hrc_check.assignment_from_var_names(
+                    self.instance, (var_names[v] for v in true_vars if v < len(var_names)))
+        return result
+
+class Driver(object):
+    """Finds the smallest max_bp for which an instance has a matching, and a largest matching
+       for that max_bp, by running a PB solver on the models for several values of max_bp at once.
+
+       The models are monotone in max_bp: if max_bp = k has a solution then so does every
+       larger bound, and if k has none then neither does any smaller bound. So when a run
+       finds a solution, runs for larger bounds are cancelled, and when a run proves that
+       there is none, runs for smaller bounds are cancelled.
+    """
+    def __init__(self, instance, command, jobs=1, timeout=None, poll_interval=0.05):
+        "instance must not have been presolved for a smaller max_bp than is searched; it is copied for each run"
+        self.instance = instance
+        self.command = command
+        self.jobs = jobs
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    def solve(self, lo, hi, strategy="race"):
+        """Search max_bp in [lo, hi]. With strategy "race", the smallest bounds that are still
+           undecided are run first; with "bisect", each run splits the largest undecided gap.
+           Returns an OrderedDict with the smallest bound found to have a solution ("max_bp",
+           or None), whether every smaller bound in the range was shown to have none ("proven"),
+           the result of the run for that bound ("best"), and the results of all the "runs".
+        """
+        self.lo, self.hi = lo, hi
+        self.sat = None     # Smallest bound with a solution
+        self.unsat = None   # Largest bound shown to have no solution
+        self.started = set()
+        running = []
+        results = {}
+        while True:
+            while len(running) < self.jobs:
+                max_bp = self.next_bound(strategy, [run.max_bp for run in running])
+                if max_bp is None:
+                    break
+                run = SolverRun(self.command, self.instance, max_bp, self.timeout)
+                run.start()
+                self.started.add(max_bp)
+                running.append(run)
+            if not running:
+                break
+            time.sleep(self.poll_interval)
+            for run in [run for run in running if run.poll()]:
+                running.remove(run)
+                result = results[run.max_bp] = run.result()
+                if result["status"] in ("optimum", "satisfiable"):
+                    self.sat = run.max_bp if self.sat is None else min(self.sat, run.max_bp)
+                elif result["status"] == "unsatisfiable":
+                    self.unsat = run.max_bp if self.unsat is None else max(self.unsat, run.max_bp)
+            for run in [run for run in running if not self.undecided(run.max_bp)]:
+                running.remove(run)
+                run.cancel()
+                results[run.max_bp] = run.result()
+
+        solution = collections.OrderedDict()
+        solution["max_bp"] = self.sat
+        undecided = range(lo if self.unsat is None else self.unsat + 1, hi + 1 if self.sat is None else self.sat)
+        solution["proven"] = self.sat is not None and not undecided
+        solution["best"] = results.get(self.sat)
+        solution["runs"] = [results[max_bp] for max_bp in sorted(results)]
+        return solution
+
+    def undecided(self, max_bp):
+        "Could running the model for max_bp still improve the result?"
+        return ((self.sat is None or max_bp < self.sat) and
+                (self.unsat is None or max_bp > self.unsat))
+
+    def next_bound(self, strategy, running):
+        "Returns the next bound to run, or None"
+        candidates = [max_bp for max_bp in range(self.lo, self.hi + 1)
+                      if max_bp not in self.started and self.undecided(max_bp)]
+        if not candidates:
+            return None
+        if strategy == "race":
+            return candidates[0]
+        # Split the largest gap between bounds that are decided, running or out of range
+        points = sorted(running + [self.lo - 1 if self.unsat is None else self.unsat,
+                                   self.hi + 1 if self.sat is None else self.sat])
+        def gap(max_bp):
+            k = next(k for k, point in enumerate(points) if point > max_bp)
+            return min(max_bp - points[k - 1], points[k] - max_bp)
+        return max(candidates, key=lambda max_bp: (gap(max_bp), -max_bp))
+
+def check_solution(instance, solution):
+    "Check the best matching in solution against instance (which must not have been presolved)"
+    best = solution["best"]
+    if best is None or "matching" not in best:
+        return None
+    return hrc_check.StabilityChecker(instance).check(best["matching"])
+
+def solve_components(instance, command, hi, jobs=1, timeout=None, strategy="race", matching=None):
+    """Solve each connected component of instance (see Instance.components) with its own Driver,
+       and combine the results. No blocking pair spans two components, so the smallest max_bp
+       for the instance is the sum of the components' smallest bounds, and the union of
+       their best matchings is a best matching for it.
+
+       instance must not have been presolved. It is presolved for hi before it is split, and each
+       component's bounds are searched from 0 to hi, or, if matching (of instance, with at most
+       hi blocking pairs) is given, to the number of its blocking pairs in that component.
+       Returns an OrderedDict like Driver.solve's, with the results of each component in
+       "components" rather than "runs".
+    """
+    base = instance.copy()
+    base.tighten_max_bp(hi)
+    components = base.components()
+    his = [hi] * len(components)
+    if matching is not None:
+        component_of = {}
+        for k, (residents, hospitals) in enumerate(components):
+            component_of.update((r, k) for r in residents)
+        his = [0] * len(components)
+        for t, r, j in hrc_check.StabilityChecker(instance).check(matching, list_pairs=True)["pairs"]:
+            his[component_of[r]] += 1
+
+    res_hosp = [None] * instance.nres
+    results = []
+    for k, (residents, hospitals) in enumerate(components):
+        sub, res_ids, hosp_ids = base.subinstance(residents, hospitals)
+        if sub.num_prefs() == 0:
+            # No resident can be assigned, and there are no blocking pairs
+            comp_solution = collections.OrderedDict([("max_bp", 0), ("proven", True),
+                    ("best", collections.OrderedDict([("max_bp", 0), ("status", "optimum"), ("objective", 0),
+                                                      ("matching", [None] * sub.nres)])),
+                    ("runs", [])])
+        else:
+            comp_solution = Driver(sub, command, jobs, timeout).solve(0, his[k], strategy)
+        best = comp_solution["best"]
+        if best is not None and "matching" in best:
+            for r, h in enumerate(best["matching"]):
+                if h is not None:
+                    res_hosp[res_ids[r]] = hosp_ids[h]
+        results.append(collections.OrderedDict([("component", k), ("residents", sub.nres),
+                ("hospitals", sub.nhosp), ("prefs", sub.num_prefs())] + comp_solution.items()))
+
+    solution = collections.OrderedDict()
+    bests = [result["best"] for result in results]
+    solved = all(result["max_bp"] is not None for result in results)
+    solution["max_bp"] = sum(result["max_bp"] for result in results) if solved else None
+    solution["proven"] = solved and all(result["proven"] for result in results)
+    solution["best"] = None
+    if solved:
+        objectives = [best["objective"] for best in bests]
+        solution["best"] = collections.OrderedDict([
+                ("max_bp", solution["max_bp"]),
+                ("status", "optimum" if all(best["status"] == "optimum" for best in bests) else "satisfiable"),
+                ("objective", None if None in objectives else sum(objectives))])
+        if all("matching" in best for best in bests):
+            solution["best"]["matching"] = res_hosp
+    solution["components"] = results
+    return solution
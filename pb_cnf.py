@@ -0,0 +1,244 @@
+from collections import deque, OrderedDict
+
+# Ways in which CNFEncoder encodes an inequality, in the order of its stats
+ENCODINGS = ["satisfied", "infeasible", "clause", "units", "pairwise", "totalizer", "counter", "adder"]
+
+CARD_ENCODINGS = ["totalizer", "counter"]
+
+class CNFEncoder(object):
+    """Encodes linear constraints over 0-1 variables as clauses, for PBModel's WCNF output.
+       Model variable v is literal v+1, and auxiliary variables are numbered after the
+       model's. Each inequality is normalised to sum(coefs[i] * lits[i]) >= degree with
+       positive coefficients. The literals whose coefficients are at least the degree
+       satisfy it on their own, so they are added to the clauses that enforce the rest:
+       a single clause if there is no rest, a cardinality constraint (with a totalizer or
+       a sequential counter) if the rest have equal coefficients, and an adder network
+       otherwise.
+    """
+    def __init__(self, num_vars, out, prefix, card_encoding="totalizer", max_pairwise=6):
+        """Clauses are written to ModelWriter out, each line starting with prefix (e.g. the
+           weight of a hard clause). An at-most-one constraint on up to max_pairwise literals
+           is encoded with a clause for each pair, rather than with card_encoding.
+        """
+        if card_encoding not in CARD_ENCODINGS:
+            raise ValueError("Unknown cardinality encoding {}".format(card_encoding))
+        self.num_vars = num_vars
+        self.out = out
+        self.prefix = prefix
+        self.card_encoding = card_encoding
+        self.max_pairwise = max_pairwise
+        self.num_clauses = 0
+        self.counts = OrderedDict((encoding, 0) for encoding in ENCODINGS)
+
+    def new_var(self):
+        self.num_vars += 1
+        return self.num_vars
+
+    def clause(self, lits, extra=()):
+        "Write the clause of lits, and of the literals in extra, if any"
+        lits = list(lits) + list(extra)
+        self.out.write(self.prefix + " ".join(map(str, lits)) + (" 0" if lits else "0"))
+        self.num_clauses += 1
+
+    def stats(self, num_model_vars):
+        "Returns the number of inequalities encoded in each way, and the size of the encoding"
+        stats = OrderedDict(self.counts)
+        stats["aux_vars"] = self.num_vars - num_model_vars
+        stats["clauses"] = self.num_clauses
+        return stats
+
+    def add_constr(self, coefs, variables, comp, rhs):
+        "Encode sum(coefs[i] * x[variables[i]]) comp rhs, where comp is one of pb_model.COMPS"
+        lits = [v + 1 for v in variables]
+        if comp != ">=":
+            self.add_at_least([-c for c in coefs], lits, -rhs)
+        if comp != "<=":
+            self.add_at_least(coefs, lits, rhs)
+
+    def add_at_least(self, coefs, lits, degree):
+        "Encode sum(coefs[i] * lits[i]) >= degree, where the lits are distinct variables or their negations"
+        terms = []
+        for c, lit in zip(coefs, lits):
+            if c < 0:   # c * lit = c - c * (1 - lit)
+                terms.append((-c, -lit))
+                degree -= c
+            elif c > 0:
+                terms.append((c, lit))
+        if degree <= 0:
+            self.counts["satisfied"] += 1
+            return
+        total = sum(c for c, lit in terms)
+        if total < degree:
+            self.counts["infeasible"] += 1
+            self.clause([])
+            return
+        either = [lit for c, lit in terms if c >= degree]
+        terms = [(c, lit) for c, lit in terms if c < degree]
+        if sum(c for c, lit in terms) < degree:
+            # The rest can't satisfy the constraint without one of either
+            self.counts["clause"] += 1
+            self.clause(either)
+        elif all(c == terms[0][0] for c, lit in terms):
+            # At least k of the rest are true, i.e. at most n-k are false; count whichever is smaller
+            lits = [lit for c, lit in terms]
+            k = (degree + terms[0][0] - 1) // terms[0][0]
+            if k <= len(lits) - k:
+                self.at_least(lits, k, either)
+            else:
+                self.at_most([-lit for lit in lits], len(lits) - k, either)
+        else:
+            self.counts["adder"] += 1
+            self.adder_at_most([(c, -lit) for c, lit in terms], sum(c for c, lit in terms) - degree, either)
+
+    def at_most(self, lits, k, either=()):
+        """Encode at most k of lits being true, for 0 <= k < len(lits), unless one of the
+           literals in either is true
+        """
+        if k == 0:
+            self.counts["units"] += 1
+            for lit in lits:
+                self.clause([-lit], either)
+        elif k == len(lits) - 1:
+            self.counts["clause"] += 1
+            self.clause([-lit for lit in lits], either)
+        elif k == 1 and len(lits) <= self.max_pairwise:
+            self.counts["pairwise"] += 1
+            for i, lit in enumerate(lits):
+                for lit2 in lits[i+1:]:
+                    self.clause([-lit, -lit2], either)
+        else:
+            self.counter(lits, k, True, either)
+
+    def at_least(self, lits, k, either=()):
+        """Encode at least k of lits being true, for 0 < k < len(lits), unless one of the
+           literals in either is true
+        """
+        if k == 1:
+            self.counts["clause"] += 1
+            self.clause(lits, either)
+        else:
+            self.counter(lits, k, False, either)
+
+    def counter(self, lits, k, upward, either):
+        "Encode at most k (if upward) or at least k of lits being true with self.card_encoding"
+        self.counts[self.card_encoding] += 1
+        if self.card_encoding == "counter":
+            self.sequential_counter(lits, k, upward, either)
+        elif upward:
+            self.clause([-self.totalizer(lits, k + 1, True)[k]], either)
+        else:
+            self.clause([self.totalizer(lits, k, False)[k-1]], either)
+
+    def totalizer(self, lits, size, upward):
+        """Returns up to size outputs of a totalizer over lits: outputs[j] means that more than j
+           of lits are true. If upward, it is forced to be true if they are, which is all that
+           an upper bound on the count needs; otherwise it is forced to be false if they aren't,
+           which is all that a lower bound needs.
+        """
+        if len(lits) == 1:
+            return lits
+        mid = len(lits) // 2
+        left, right = self.totalizer(lits[:mid], size, upward), self.totalizer(lits[mid:], size, upward)
+        outputs = [self.new_var() for j in range(min(len(left) + len(right), size))]
+        for i in range(len(left) + 1):
+            for j in range(len(right) + 1):
+                if upward:
+                    if 0 < i + j <= len(outputs):
+                        self.clause(([-left[i-1]] if i else []) + ([-right[j-1]] if j else []) + [outputs[i+j-1]])
+                elif i + j < len(outputs):
+                    self.clause(([left[i]] if i < len(left) else []) + ([right[j]] if j < len(right) else []) +
+                                [-outputs[i+j]])
+        return outputs
+
+    def sequential_counter(self, lits, k, upward, either=()):
+        """Encode at most k (if upward) or at least k of lits being true, unless one of the literals
+           in either is, with a sequential counter (Sinz, 2005): after lits[i], counts[j] means that
+           more than j of lits[:i+1] are true. As in totalizer, it is forced to be true if they are
+           for an upper bound, and to be false if they aren't for a lower bound.
+        """
+        counts = []
+        for i, lit in enumerate(lits):
+            if upward and len(counts) == k:
+                self.clause([-lit, -counts[k-1]], either)
+            if upward and i == len(lits) - 1:
+                break
+            new_counts = [self.new_var() for j in range(min(i + 1, k))]
+            for j, count in enumerate(new_counts):
+                prev = [counts[j]] if j < len(counts) else []
+                if upward:
+                    if prev:
+                        self.clause([-prev[0], count])
+                    self.clause([-lit, count] + ([-counts[j-1]] if j else []))
+                else:
+                    self.clause([-count, lit] + prev)
+                    if j:
+                        self.clause([-count, counts[j-1]] + prev)
+            counts = new_counts
+        if not upward:
+            self.clause([counts[k-1]], either)
+
+    def adder_at_most(self, terms, bound, either=()):
+        """Encode sum(c * lit for c, lit in terms) <= bound, for positive coefficients c and
+           bound >= 0, unless one of the literals in either is true, with an adder network
+           (Een and Sorensson, 2006): the weighted literals are summed into a binary number
+           by full and half adders, which is then compared with bound.
+        """
+        buckets = []   # buckets[b] holds the literals of weight 2**b that are still to be added
+        for c, lit in terms:
+            b = 0
+            while c:
+                if c & 1:
+                    while len(buckets) <= b:
+                        buckets.append(deque())
+                    buckets[b].append(lit)
+                c >>= 1
+                b += 1
+        bits = []   # The sum's binary digits, or None for a digit that is always 0
+        b = 0
+        while b < len(buckets):
+            bucket = buckets[b]
+            while len(bucket) > 1:
+                if len(bucket) > 2:
+                    digit, carry = self.full_adder(bucket.popleft(), bucket.popleft(), bucket.popleft())
+                else:
+                    digit, carry = self.half_adder(bucket.popleft(), bucket.popleft())
+                bucket.append(digit)
+                if b + 1 == len(buckets):
+                    buckets.append(deque())
+                buckets[b+1].append(carry)
+            bits.append(bucket[0] if bucket else None)
+            b += 1
+        # The sum exceeds bound if, at some digit where bound has a 0, the sum has a 1 and
+        # every higher digit where bound has a 1 is also 1 in the sum
+        for i, bit in enumerate(bits):
+            if bit is None or bound >> i & 1:
+                continue
+            higher = [j for j in range(i + 1, max(len(bits), bound.bit_length())) if bound >> j & 1]
+            if all(j < len(bits) and bits[j] is not None for j in higher):
+                self.clause([-bit] + [-bits[j] for j in higher], either)
+
+    def full_adder(self, x, y, z):
+        "Returns (sum, carry) literals equal to the digits of x + y + z"
+        digit, carry = self.new_var(), self.new_var()
+        for vx in (0, 1):
+            for vy in (0, 1):
+                for vz in (0, 1):
+                    # If x, y, z = vx, vy, vz then digit is their parity
+                    self.clause([-x if vx else x, -y if vy else y, -z if vz else z,
+                                 digit if (vx + vy + vz) % 2 else -digit])
+        for a, b in [(x, y), (x, z), (y, z)]:
+            self.clause([-a, -b, carry])
+            self.clause([a, b, -carry])
+        return digit, carry
+
+    def half_adder(self, x, y):
+        "Returns (sum, carry) literals equal to the digits of x + y"
+        digit, carry = self.new_var(), self.new_var()
+        self.clause([x, y, -digit])
+        self.clause([-x, -y, -digit])
+        self.clause([-x, y, digit])
+        self.clause([x, -y, digit])
+        self.clause([-x, -y, carry])
+        self.clause([x, -carry])
+        self.clause([y, -carry])
+        return digit, carry
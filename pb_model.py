@@ -1,86 +1,759 @@
-from collections import namedtuple
+from array import array
+from bisect import bisect_right
+from collections import namedtuple, OrderedDict
+from itertools import compress, imap
+import shutil
+import tempfile
+
+import pb_cnf
 
 Constraint = namedtuple('Constraint', ['terms', 'comp', 'rhs', 'name'])
 
+COMPS = ["<=", ">=", "="]
+COMP_CODES = {comp: code for code, comp in enumerate(COMPS)}
+MPS_ROW_TYPES = "LGE"   # indexed by comparator code
+
+# Output formats. Only .opb and FlatZinc models can be streamed, as the others aren't
+# written one constraint at a time.
+FORMATS = ["opb", "flatzinc", "wcnf", "lp", "mps"]
+STREAM_FORMATS = ["opb", "flatzinc"]
+
+# Reductions made by PBModel.presolve, in the order in which they are applied
+PRESOLVE_RULES = ["merged_terms", "fixed_vars", "satisfied_constrs", "tightened_coefs", "duplicate_constrs",
+                  "unused_vars"]
+
+class VarNames(object):
+    """The names of a model's variables. Each name is stored as an interned format string
+       plus its integer arguments, and is only formatted when it is looked up.
+    """
+    def __init__(self):
+        self.fmts = []
+        self.fmt_ids = {}
+        self.fmt_idx = array('i')
+        self.args = array('i')
+        self.arg_starts = array('l', [0])
+
+    def append(self, fmt, args=()):
+        fmt_id = self.fmt_ids.get(fmt)
+        if fmt_id is None:
+            fmt_id = self.fmt_ids[fmt] = len(self.fmts)
+            self.fmts.append(fmt)
+        self.fmt_idx.append(fmt_id)
+        self.args.extend(args)
+        self.arg_starts.append(len(self.args))
+
+    def __len__(self):
+        return len(self.fmt_idx)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        fmt = self.fmts[self.fmt_idx[i]]
+        start, end = self.arg_starts[i], self.arg_starts[i+1]
+        return fmt.format(*self.args[start:end]) if end > start else fmt
+
+    def count_by_fmt(self, indices=None):
+        """Returns an OrderedDict from each name format to the number of variables using it,
+           counting only the variables in indices if it is given
+        """
+        counts = [0] * len(self.fmts)
+        fmt_idx = self.fmt_idx
+        for fmt_id in (fmt_idx if indices is None else (fmt_idx[i] for i in indices)):
+            counts[fmt_id] += 1
+        return OrderedDict(zip(self.fmts, counts))
+
+    def __iter__(self):
+        fmts, fmt_idx, args, arg_starts = self.fmts, self.fmt_idx, self.args, self.arg_starts
+        for i in range(len(fmt_idx)):
+            fmt = fmts[fmt_idx[i]]
+            start, end = arg_starts[i], arg_starts[i+1]
+            yield fmt.format(*args[start:end]) if end > start else fmt
+
+def merge_terms(coefs, variables):
+    "Returns (coefs, variables) with each variable's terms added together, leaving out zero coefficients"
+    total = OrderedDict()
+    for c, v in zip(coefs, variables):
+        total[v] = total.get(v, 0) + c
+    return array('i', [c for c in total.values() if c]), array('i', [v for v, c in total.items() if c])
+
+def activity_bounds(coefs):
+    "Returns the smallest and largest values of sum(coefs[i] * x[i]) over 0-1 values x"
+    if not coefs:
+        return 0, 0
+    total = sum(coefs)
+    if min(coefs) >= 0:
+        return 0, total
+    if max(coefs) <= 0:
+        return total, 0
+    min_act = sum(c for c in coefs if c < 0)
+    return min_act, total - min_act
+
+def constr_outcome(coefs, comp, rhs):
+    """What propagation learns from a constraint with coefficients coefs on distinct variables.
+       Returns "infeasible" if it can't be satisfied, "satisfied" if it always is, and otherwise
+       a tuple (loose, forced): whether tighten_coefs can reduce it, and the (position, value)
+       pairs of the variables that it forces to a value. This depends only on the coefficients,
+       the comparator and the right-hand side, so PBModel.propagate works it out once for each.
+    """
+    upper = comp != ">="   # is rhs an upper bound on the left-hand side?
+    lower = comp != "<="
+    min_act, max_act = activity_bounds(coefs)
+    if (upper and min_act > rhs) or (lower and max_act < rhs):
+        return "infeasible"
+    if (not upper or max_act <= rhs) and (not lower or min_act >= rhs):
+        return "satisfied"
+    max_coef = max(max(coefs), -min(coefs))
+    loose = comp != "=" and max_coef > (max_act - rhs if upper else rhs - min_act)
+    forced = []
+    if (not upper or min_act + max_coef <= rhs) and (not lower or max_act - max_coef >= rhs):
+        return loose, forced   # no single variable is forced
+    for i, c in enumerate(coefs):
+        # Would the other value of the variable break the constraint, with the rest at their best?
+        if upper and min_act + abs(c) > rhs:
+            forced.append((i, int(c < 0)))
+        if lower and max_act - abs(c) < rhs:
+            forced.append((i, int(c > 0)))
+    return loose, forced
+
+def tighten_coefs(coefs, comp, rhs):
+    """Reduce the coefficients of a "<=" or ">=" constraint that are larger in magnitude than
+       its degree: the amount by which the left-hand side must move from its loosest value to
+       satisfy the constraint. Moving such a term from its loosest value satisfies the
+       constraint by itself, so the excess makes no difference. Returns (coefs, rhs, number of
+       coefficients reduced).
+    """
+    min_act, max_act = activity_bounds(coefs)
+    degree = max_act - rhs if comp == "<=" else rhs - min_act
+    if degree <= 0 or (max(coefs) <= degree and -min(coefs) <= degree):
+        return coefs, rhs, 0
+    num_reduced = sum(abs(c) > degree for c in coefs)
+    coefs = array('i', [max(min(c, degree), -degree) for c in coefs])
+    min_act, max_act = activity_bounds(coefs)
+    return coefs, max_act - degree if comp == "<=" else min_act + degree, num_reduced
+
+def replace_terms(coefs, variables, starts, ends, k, new_coefs, new_vars):
+    """Replace the terms of constraint k in PBModel.presolve's arrays by new_coefs and new_vars,
+       which are no more terms, moving ends[k] down. The places freed get the variable -1.
+    """
+    start, end = starts[k], ends[k]
+    ends[k] = start + len(new_vars)
+    coefs[start:ends[k]] = new_coefs
+    variables[start:ends[k]] = new_vars
+    variables[ends[k]:end] = array('i', [-1]) * (end - ends[k])
+
+def lp_terms(coefs, variables, per_line=16):
+    "Format a linear expression for LP format, starting a new line after every per_line terms"
+    terms = ["%+d x%d" % (c, v+1) for c, v in zip(coefs, variables)] or ["0 x1"]
+    return "\n".join(" " + " ".join(terms[i:i+per_line]) for i in range(0, len(terms), per_line))
+
+def copy_spool(spool, out):
+    "Copy the lines written to spool, a ModelWriter on a temporary file, to ModelWriter out"
+    spool.flush()
+    out.flush()
+    spool.f.seek(0)
+    shutil.copyfileobj(spool.f, out.f, 1 << 20)
+
+class ModelWriter(object):
+    """Collects output lines and writes them to a file in large chunks,
+       rather than making one write call per line.
+    """
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.lines = []
+        self.size = 0
+
+    def write(self, line):
+        self.lines.append(line)
+        self.size += len(line)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.lines.append("")   # for the trailing newline
+            self.f.write("\n".join(self.lines))
+            self.lines = []
+            self.size = 0
+
 class PBModel(object):
-    def __init__(self, flatzinc):
-        self.var_names = []
-        self.constrs = []
-        self.flatzinc = flatzinc
+    def __init__(self, fmt, stream=False, quiet=False, presolve=True, card_encoding="totalizer"):
+        """fmt is the output format, one of FORMATS. WCNF, LP and MPS models have a single
+           objective, with the penalty variables weighted first (see weighted_objective).
+           card_encoding is the encoding of cardinality constraints in WCNF (see pb_cnf).
+           If stream is True, each constraint is formatted as soon as it is added and spooled
+           to a temporary file, rather than being stored until write() is called.
+           (The header lines, which depend on the final size of the model, are written
+           before the spooled constraints.) quiet controls the comments on spooled constraints.
+           If presolve is True, the stored constraints are simplified before they are written;
+           see presolve. A streamed model isn't presolved.
+        """
+        if fmt not in FORMATS:
+            raise ValueError("Unknown model format {}".format(fmt))
+        if stream and fmt not in STREAM_FORMATS:
+            raise ValueError("A {} model can't be streamed".format(fmt))
+        self.var_names = VarNames()
+        # Names of variables that were replaced by aliases, and the variable used for each; see create_alias
+        self.alias_names = VarNames()
+        self.alias_vars = array('i')
+        # Constraint k has terms zip(self.coefs[s:e], self.vars[s:e]) where s, e = self.starts[k:k+2],
+        # comparator COMPS[self.comps[k]], right-hand side self.rhs[k] and name
+        # self.constr_names[self.name_idx[k]]
+        self.coefs = array('i')
+        self.vars = array('i')
+        self.starts = array('l', [0])
+        self.comps = array('b')
+        self.rhs = array('l')
+        self.name_idx = array('i')
+        self.constr_names = []
+        self.constr_name_ids = {}
+        self.comments = []
+        self.hint = []   # (variable, value) pairs; see set_hint
+        self.penalty_vars = array('i')   # see set_penalty_vars
+        self.fmt = fmt
+        self.card_encoding = card_encoding
+        self.cnf_stats = None
+        self.quiet = quiet
+        self.spool = ModelWriter(tempfile.TemporaryFile()) if stream else None
+        self.spooled_constrs = 0
+        self.spooled_terms = 0
+        self.spooled_name_counts = OrderedDict()
+        self.use_presolve = presolve
+        self.presolve_stats = None
+        # After presolve, variables are renumbered: output_vars[k] is the variable written as x{k+1}
+        self.output_vars = None
 
-    def create_var(self, name):
-        self.var_names.append(name)
+    def create_var(self, name, *args):
+        """Create a variable and return its index. If args are given, the variable's name
+           is name.format(*args); the formatting is deferred until the name is needed.
+        """
+        self.var_names.append(name, args)
         return len(self.var_names) - 1
 
+    def create_alias(self, var, name, *args):
+        """Returns var, for use in place of a new variable named name.format(*args) that would
+           only be constrained to be equal to var. This saves a variable and a constraint.
+           The alias's name is kept for the comments, and aliases are counted in stats().
+        """
+        self.alias_names.append(name, args)
+        self.alias_vars.append(var)
+        return var
+
     def add_constr(self, constr):
-        self.constrs.append(constr)
+        self.add_linear_constr([c for c, v in constr.terms], [v for c, v in constr.terms],
+                constr.comp, constr.rhs, constr.name)
+
+    def add_linear_constr(self, coefs, variables, comp, rhs, name="UNNAMED"):
+        """Add the constraint sum(coefs[i] * variables[i]) comp rhs. coefs and variables are
+           lists, which are appended to the stored arrays with fromlist, as that is quicker than extend.
+        """
+        if self.spool is not None:
+            self.format_constr(self.spool, coefs, variables, comp, rhs, name, self.quiet)
+            self.spooled_constrs += 1
+            self.spooled_terms += len(variables)
+            self.spooled_name_counts[name] = self.spooled_name_counts.get(name, 0) + 1
+            return
+        self.coefs.fromlist(coefs)
+        self.vars.fromlist(variables)
+        self.starts.append(len(self.vars))
+        self.comps.append(COMP_CODES[comp])
+        self.rhs.append(rhs)
+        name_id = self.constr_name_ids.get(name)
+        self.name_idx.append(self.constr_name_id(name) if name_id is None else name_id)
 
     def add_sum_leq_constr(self, variables, rhs, name="UNNAMED"):
-        self.constrs.append(Constraint([(1, variable) for variable in variables], "<=", rhs, name))
+        self.add_linear_constr([1] * len(variables), variables, "<=", rhs, name)
 
     def add_sum_eq_constr(self, variables, rhs, name="UNNAMED"):
-        self.constrs.append(Constraint([(1, variable) for variable in variables], "=", rhs, name))
+        self.add_linear_constr([1] * len(variables), variables, "=", rhs, name)
 
     def add_exactly_one_constr(self, variables, name="UNNAMED"):
-        self.constrs.append(Constraint([(1, variable) for variable in variables], "=", 1, name))
+        self.add_linear_constr([1] * len(variables), variables, "=", 1, name)
+
+    def num_vars(self):
+        "The number of variables written: all the variables, unless presolve has removed some"
+        return len(self.var_names) if self.output_vars is None else len(self.output_vars)
+
+    def output_var_names(self):
+        "The names of the variables written, in order"
+        if self.output_vars is None:
+            return list(self.var_names)
+        return [self.var_names[v] for v in self.output_vars]
+
+    def num_constrs(self):
+        return len(self.comps) + self.spooled_constrs
+
+    def num_terms(self):
+        return len(self.vars) + self.spooled_terms
+
+    def constr_counts_by_name(self):
+        "Returns an OrderedDict from each constraint name to the number of constraints with that name"
+        counts = [0] * len(self.constr_names)
+        for name_id in self.name_idx:
+            counts[name_id] += 1
+        by_name = OrderedDict(zip(self.constr_names, counts))
+        for name, count in self.spooled_name_counts.items():
+            by_name[name] = by_name.get(name, 0) + count
+        return by_name
+
+    def stats(self):
+        """Returns the size of the model as written, broken down by constraint name and variable
+           name format. After presolve, only the variables that are still used are counted.
+        """
+        return OrderedDict([
+                ("variables", self.num_vars()),
+                ("constraints", self.num_constrs()),
+                ("terms", self.num_terms()),
+                ("constraints_by_name", self.constr_counts_by_name()),
+                ("variables_by_name", self.var_names.count_by_fmt(self.output_vars)),
+                ("aliases_by_name", self.alias_names.count_by_fmt()),
+                ("presolve", self.presolve_stats),
+                ("cnf", self.cnf_stats)])
+
+    def stored_constrs(self):
+        """Iterate over the stored (not spooled) constraints as
+           (coefs, variables, comp, rhs, name) tuples.
+        """
+        coefs, variables, starts = self.coefs, self.vars, self.starts
+        for k in range(len(self.comps)):
+            start, end = starts[k], starts[k+1]
+            yield (coefs[start:end].tolist(), variables[start:end].tolist(), COMPS[self.comps[k]], self.rhs[k],
+                   self.constr_names[self.name_idx[k]])
+
+    def iter_constrs(self):
+        "Iterate over the stored constraints as Constraint tuples"
+        for coefs, variables, comp, rhs, name in self.stored_constrs():
+            yield Constraint(zip(coefs, variables), comp, rhs, name)
 
-    def show_objective(self):
-        print "* Objective: max:"
-        print "*     ", " ".join("{}*{}".format(i, self.var_names[j]) for i, j in self.objective)
+    def show_objective(self, out, var_names):
+        out.write("* Objective: max:")
+        out.write("*      " + " ".join("{}*{}".format(i, var_names[j]) for i, j in self.objective))
 
-    def show_var_names(self):
-        for i, name in enumerate(self.var_names):
-            print "*", "NAME", i+1, name
+    def show_var_names(self, out, var_names, prefix="* "):
+        for i, name in enumerate(var_names):
+            out.write("%sNAME %d %s" % (prefix, i+1, name))
+        output_num = self.output_numbers()
+        for var, name in zip(self.alias_vars, self.alias_names):
+            if output_num[var] >= 0:
+                out.write("%sALIAS %d %s" % (prefix, output_num[var]+1, name))
+
+    def output_numbers(self):
+        "Returns the index of each variable in the output (x{index+1}), or -1 if presolve removed it"
+        if self.output_vars is None:
+            return range(len(self.var_names))
+        output_num = array('i', [-1]) * len(self.var_names)
+        for k, v in enumerate(self.output_vars):
+            output_num[v] = k
+        return output_num
 
     def add_objective(self, objective):
         self.objective = objective
 
-    def write_model_size_comment(self):
-        print "* #variable= {} #constraint= {}".format(len(self.var_names), len(self.constrs))
+    def set_penalty_vars(self, variables):
+        """Set the variables whose number of true values is to be minimised before the objective
+           is maximised (in HRC, the blocking pair variables). This is only used by the formats
+           with a single weighted objective; in .opb and FlatZinc they are only constrained.
+        """
+        self.penalty_vars = array('i', variables)
+
+    def weighted_objective(self):
+        """Returns (weight, terms): the terms (coef, variable) of a single objective to minimise,
+           in which each penalty variable has a weight larger than the range of the objective,
+           so that a minimum has as few true penalty variables as possible and, of those
+           assignments, the largest objective.
+        """
+        weight = sum(abs(c) for c, v in self.objective) + 1
+        coefs = OrderedDict((v, weight) for v in self.penalty_vars)
+        for c, v in self.objective:
+            coefs[v] = coefs.get(v, 0) - c
+        return weight, [(c, v) for v, c in coefs.items() if c]
+
+    def set_hint(self, var_values):
+        """Set a partial assignment, as (variable, value) pairs, to be given to the solver
+           as a starting point: in FlatZinc, as a warm_start annotation; for .opb, see write_hint
+        """
+        self.hint = var_values
+
+    def add_comment(self, comment):
+        "Add a comment to be written after the model size comment"
+        self.comments.append(comment)
+
+    def write_model_size_comment(self, out):
+        out.write("* #variable= {} #constraint= {}".format(self.num_vars(), self.num_constrs()))
+        self.write_comments(out)
+
+    def write_comments(self, out, prefix="* "):
+        "Write the comments added by add_comment, and the reductions made by presolve"
+        for comment in self.comments:
+            out.write(prefix + comment)
+        if self.presolve_stats is not None:
+            out.write(prefix + "Model presolve: " + ", ".join("{} {}".format(n, rule.replace("_", " "))
+                                                              for rule, n in self.presolve_stats.items()))
+
+    def format_constr(self, out, coefs, variables, comp, rhs, name, quiet):
+        if self.fmt == "flatzinc":
+            self.format_flatzinc_constr(out, coefs, variables, comp, rhs)
+        else:
+            self.format_opb_constr(out, coefs, variables, comp, rhs, name, quiet, self.var_names)
+
+    def format_opb_constr(self, out, coefs, variables, comp, rhs, name, quiet, var_names):
+        "var_names is used for the comments; it is ignored if quiet is True"
+        if not quiet:
+            out.write("*  " + name + ":")
+            out.write(" ".join(["*     ", " ".join(["%d*%s" % (i, var_names[j]) for i, j in zip(coefs, variables)]),
+                                comp, str(rhs)]))
+        if comp == "<=":
+            out.write(" ".join([" ".join(["%+d x%d" % (-i, j+1) for i, j in zip(coefs, variables)]),
+                                ">=", "%d;" % -rhs]))
+        else:
+            out.write(" ".join([" ".join(["%+d x%d" % (i, j+1) for i, j in zip(coefs, variables)]),
+                                comp, "%d;" % rhs]))
+        if not quiet:
+            out.write("*")
+
+    def format_flatzinc_constr(self, out, coefs, variables, comp, rhs):
+        if comp == ">=":
+            coefs = [-i for i in coefs]
+            rhs = -rhs
+        out.write("constraint int_lin_%s([%s],[%s],%d);" % (
+                "eq" if comp == "=" else "le",
+                ",".join([str(i) for i in coefs]),
+                ",".join(["x[%d]" % (j+1) for j in variables]),
+                rhs))
+
+    def write_model(self, out, quiet, var_names):
+        out.write("min: " + " ".join("-" + str(t[0]) + " " + "x{}".format(t[1]+1) for t in self.objective) + ";")
+        for coefs, variables, comp, rhs, name in self.stored_constrs():
+            self.format_opb_constr(out, coefs, variables, comp, rhs, name, quiet, var_names)
+        self.write_spooled(out)
+
+    def write_flatzinc(self, out):
+        out.write("array[1..{}] of var 0..1: x;".format(self.num_vars()))
+        out.write("var int: obj :: output_var;")
+        out.write("constraint int_lin_eq([{},-1],[{},obj],0);".format(
+                ",".join(str(t[0]) for t in self.objective),
+                ",".join("x[{}]".format(t[1]+1) for t in self.objective)))
+        for coefs, variables, comp, rhs, name in self.stored_constrs():
+            self.format_flatzinc_constr(out, coefs, variables, comp, rhs)
+        self.write_spooled(out)
+        if self.hint:
+            out.write("solve :: warm_start([{}],[{}]) maximize obj;".format(
+                    ",".join("x[{}]".format(v+1) for v, value in self.hint),
+                    ",".join(str(value) for v, value in self.hint)))
+        else:
+            out.write("solve maximize obj;")
+
+    def write_wcnf(self, out, quiet, var_names):
+        """Write the model as weighted MaxSAT, in the WCNF format with a "p wcnf" header. The
+           constraints are hard clauses, encoded by pb_cnf.CNFEncoder; the weighted objective
+           (see weighted_objective) is a soft clause for each term. Clause variable k+1 is x{k+1}.
+        """
+        weight, objective = self.weighted_objective()
+        top = sum(abs(c) for c, v in objective) + 1
+        spool = ModelWriter(tempfile.TemporaryFile())
+        encoder = pb_cnf.CNFEncoder(self.num_vars(), spool, "%d " % top, self.card_encoding)
+        for coefs, variables, comp, rhs, name in self.stored_constrs():
+            if len(set(variables)) < len(variables):
+                coefs, variables = merge_terms(coefs, variables)
+            encoder.add_constr(coefs, variables, comp, rhs)
+        self.cnf_stats = encoder.stats(self.num_vars())
+
+        self.write_comments(out, "c ")
+        out.write("c CNF encoding ({} for cardinality constraints): {}".format(self.card_encoding,
+                ", ".join("{} {}".format(n, key.replace("_", " ")) for key, n in self.cnf_stats.items())))
+        out.write("c Objective: minimise the weights of the false soft clauses; each penalty var costs {}".format(
+                weight))
+        if not quiet:
+            self.show_var_names(out, var_names, "c ")
+        out.write("p wcnf {} {} {}".format(encoder.num_vars, encoder.num_clauses + len(objective), top))
+        # A term c * x to minimise is a soft clause -x with weight c, or x with weight -c if c < 0
+        for c, v in objective:
+            out.write("%d %d 0" % (abs(c), -(v+1) if c > 0 else v+1))
+        copy_spool(spool, out)
+
+    def write_lp(self, out, quiet, var_names):
+        "Write the model in CPLEX LP format, minimising the weighted objective (see weighted_objective)"
+        weight, objective = self.weighted_objective()
+        self.write_comments(out, "\\ ")
+        out.write("\\ Objective: each penalty var costs {}".format(weight))
+        if not quiet:
+            self.show_var_names(out, var_names, "\\ ")
+        out.write("Minimize")
+        out.write(" obj:" + lp_terms([c for c, v in objective], [v for c, v in objective]))
+        out.write("Subject To")
+        for k, (coefs, variables, comp, rhs, name) in enumerate(self.stored_constrs()):
+            if not quiet:
+                out.write("\\ " + name)
+            out.write(" c%d:%s %s %d" % (k+1, lp_terms(coefs, variables), comp, rhs))
+        out.write("Binary")
+        num_vars = self.num_vars()
+        for start in range(0, num_vars, 16):
+            out.write(" " + " ".join("x%d" % (v+1) for v in range(start, min(start + 16, num_vars))))
+        out.write("End")
 
-    def write_model(self, quiet):
-        print "min:", " ".join("-" + str(t[0]) + " " + "x{}".format(t[1]+1) for t in self.objective) + ";"
-        for c in self.constrs:
+    def write_mps(self, out, quiet, var_names):
+        "Write the model in free MPS format, minimising the weighted objective (see weighted_objective)"
+        weight, objective = self.weighted_objective()
+        self.write_comments(out)
+        out.write("* Objective: each penalty var costs {}".format(weight))
+        if not quiet:
+            self.show_var_names(out, var_names)
+        out.write("NAME hrc")
+        out.write("ROWS")
+        out.write(" N obj")
+        for k, comp_code in enumerate(self.comps):
             if not quiet:
-                print "* ", c.name+":"
-                print "*     ", " ".join("{}*{}".format(i, self.var_names[j]) for i, j in c[0]), c[1], c[2]
-            if c.comp == "<=":
-                print " ".join("{:+d} x{}".format(-i, j+1) for i, j in c[0]), ">=", str(-c[2]) + ";"
+                out.write("* " + self.constr_names[self.name_idx[k]])
+            out.write(" %s c%d" % (MPS_ROW_TYPES[comp_code], k+1))
+
+        # MPS lists the coefficients by column, so sort the terms by variable
+        num_vars = self.num_vars()
+        col_starts = array('l', [0]) * (num_vars + 1)
+        for v in self.vars:
+            col_starts[v+1] += 1
+        for v in range(num_vars):
+            col_starts[v+1] += col_starts[v]
+        col_rows, col_coefs = array('l', [0]) * len(self.vars), array('i', [0]) * len(self.vars)
+        pos = array('l', col_starts)
+        starts = self.starts
+        for k in range(len(self.comps)):
+            for i in range(starts[k], starts[k+1]):
+                v = self.vars[i]
+                col_rows[pos[v]], col_coefs[pos[v]] = k, self.coefs[i]
+                pos[v] += 1
+        obj_coefs = dict((v, c) for c, v in objective)
+
+        out.write("COLUMNS")
+        for v in range(num_vars):
+            if v in obj_coefs or col_starts[v] == col_starts[v+1]:
+                out.write("    x%d obj %d" % (v+1, obj_coefs.get(v, 0)))
+            for i in range(col_starts[v], col_starts[v+1]):
+                if col_coefs[i]:
+                    out.write("    x%d c%d %d" % (v+1, col_rows[i]+1, col_coefs[i]))
+        out.write("RHS")
+        for k, rhs in enumerate(self.rhs):
+            if rhs:
+                out.write("    rhs c%d %d" % (k+1, rhs))
+        out.write("BOUNDS")
+        for v in range(num_vars):
+            out.write(" BV bnd x%d" % (v+1))
+        out.write("ENDATA")
+
+    def presolve(self):
+        """Simplify the stored constraints, once, before they are written. The rules, whose
+           reductions are counted in self.presolve_stats, are applied in this order:
+           duplicate terms in a constraint are merged; variables fixed by a constraint are
+           propagated, and constraints that are then always satisfied are dropped; coefficients
+           larger than a constraint's bound are reduced to it; of constraints with the same
+           terms, only the tightest is kept; and variables that no longer appear are removed,
+           renumbering the rest (see output_vars).
+
+           Variables in the objective that are fixed to 1 are kept, with a unit constraint, so
+           that the objective value and the solution's assignment are unchanged. If propagation
+           finds that the model is infeasible, the model is left unchanged for the solver to
+           prove it. A streamed model can't be presolved.
+        """
+        if self.spool is not None or self.presolve_stats is not None:
+            return
+        stats = self.presolve_stats = OrderedDict((rule, 0) for rule in PRESOLVE_RULES)
+        # Presolve works on copies of the stored arrays, in which the terms of constraint k are
+        # coefs[starts[k]:ends[k]] and variables[starts[k]:ends[k]]. Terms that are removed are
+        # dropped by moving the rest down and reducing ends[k].
+        coefs, variables, starts = self.coefs[:], self.vars[:], self.starts[:]
+        ends, rhs, name_idx = starts[1:], self.rhs[:], self.name_idx[:]
+        comps = self.comps
+        kept = array('b', [1]) * len(comps)   # 0 for the constraints that are always satisfied
+        loose = set()
+        value = self.propagate(coefs, variables, starts, ends, comps, rhs, kept, loose)
+        if value is None:
+            self.presolve_stats = OrderedDict([("infeasible", 1)])
+            return
+        stats["fixed_vars"] = len(value)
+        tightened = {}   # (comparator code, rhs, coefficients) -> tighten_coefs
+        for k in sorted(loose):
+            if kept[k]:
+                start, end = starts[k], ends[k]
+                key = (comps[k], rhs[k], coefs[start:end].tostring())
+                if key not in tightened:
+                    tightened[key] = tighten_coefs(coefs[start:end], COMPS[comps[k]], rhs[k])
+                coefs[start:end], rhs[k], num_reduced = tightened[key]
+                stats["tightened_coefs"] += num_reduced
+        stats["satisfied_constrs"] = kept.count(0)
+        # Of constraints with the same terms, keep the first, with the tightest right-hand side and
+        # its name. Only the constraints whose variables have the same hash as another's can be.
+        order = list(compress(range(len(comps)), kept))
+        hashes = [hash(variables[starts[k]:ends[k]].tostring()) for k in order]
+        if len(set(hashes)) < len(hashes):
+            seen, shared = set(), set()
+            for h in hashes:
+                if h in seen:
+                    shared.add(h)
+                seen.add(h)
+            tightest = {}   # (comp, coefs, variables) -> the first constraint with them
+            for k, h in zip(order, hashes):
+                if h not in shared:
+                    continue
+                comp = comps[k]
+                j = tightest.setdefault((comp, coefs[starts[k]:ends[k]].tostring(),
+                                         variables[starts[k]:ends[k]].tostring()), k)
+                if j != k and (COMPS[comp] != "=" or rhs[k] == rhs[j]):
+                    stats["duplicate_constrs"] += 1
+                    kept[k] = 0
+                    if (rhs[k] < rhs[j]) if COMPS[comp] == "<=" else (rhs[k] > rhs[j]):
+                        rhs[j], name_idx[j] = rhs[k], name_idx[k]
+            order = list(compress(range(len(comps)), kept))
+        hashes = None
+
+        # Write the constraints that are kept back to the stored arrays. Runs of consecutive
+        # constraints with no terms removed are copied together.
+        out_coefs, out_vars, out_starts = self.coefs, self.vars, self.starts = array('i'), array('i'), array('l', [0])
+        self.comps, self.rhs, self.name_idx = array('b'), array('l'), array('i')
+        order.append(None)   # to copy the last run
+        first = last = order[0]
+        for k in order[1:]:
+            if k == last + 1 and ends[last] == starts[k]:
+                last = k
+                continue
+            shift = starts[first] - len(out_vars)
+            out_coefs.extend(coefs[starts[first]:ends[last]])
+            out_vars.extend(variables[starts[first]:ends[last]])
+            out_starts.extend([start - shift for start in starts[first+1:last+1]])
+            out_starts.append(ends[last] - shift)
+            self.comps.extend(comps[first:last+1])
+            self.rhs.extend(rhs[first:last+1])
+            self.name_idx.extend(name_idx[first:last+1])
+            first = last = k
+        order = coefs = variables = None   # free them before renumbering
+
+        # The constraints left have no fixed variables, so these unit constraints aren't duplicates
+        objective_vars = set(v for c, v in self.objective)
+        objective_vars.update(self.penalty_vars)
+        for v in sorted(v for v, x in value.items() if x == 1 and v in objective_vars):
+            self.add_linear_constr([1], [v], ">=", 1, "Fixed by model presolve")
+
+        # Renumber the variables that are still used
+        self.objective = [(c, v) for c, v in self.objective if value.get(v) != 0]
+        self.penalty_vars = array('i', [v for v in self.penalty_vars if value.get(v) != 0])
+        used = set(self.vars)
+        used.update(v for c, v in self.objective)
+        used.update(self.penalty_vars)
+        self.output_vars = array('i', sorted(used))
+        stats["unused_vars"] = (len(self.var_names) - len(self.output_vars) -
+                                sum(v not in objective_vars or x == 0 for v, x in value.items()))
+        output_num = self.output_numbers()
+        renumbered = array('i')
+        for start in range(0, len(self.vars), 1 << 16):   # in chunks, to bound the size of the lists
+            renumbered.fromlist(map(output_num.__getitem__, self.vars[start:start + (1 << 16)]))
+        self.vars = renumbered
+        self.objective = [(c, output_num[v]) for c, v in self.objective]
+        self.penalty_vars = array('i', [output_num[v] for v in self.penalty_vars])
+        self.hint = [(output_num[v], x) for v, x in self.hint if output_num[v] >= 0]
+
+    def propagate(self, coefs, variables, starts, ends, comps, rhs, kept, loose):
+        """Fix the variables that a constraint forces to a value, substituting fixed variables
+           into the constraints, until there are no more to fix. The constraints are in presolve's
+           arrays (see presolve), and comps and rhs are their comparator codes and right-hand sides.
+           This is done in rounds. The first visits every constraint; each later round visits the
+           constraints with a variable fixed in the previous round, and substitutes the fixed
+           variables. These constraints are found by scanning the variables array for them, which
+           is done at C speed, unlike building lists of each variable's constraints. (Propagation
+           reaches the same fixed point in any order, so substituting can wait for the next round.) The first round also merges duplicate terms, counting them
+           in presolve_stats. Constraints that become always satisfied get kept[k] = 0.
+           Returns a dict of the fixed variables' values, or None if a constraint can't be
+           satisfied. The indices of inequalities that tighten_coefs can reduce are added to set
+           loose.
+        """
+        value = {}
+        outcomes = {}   # (comparator code, rhs, coefficients) -> constr_outcome
+        visit = range(len(comps))
+        first = True
+        while visit:
+            fixed = set()
+            for k in visit:
+                if not kept[k]:
+                    continue
+                start, end, comp = starts[k], ends[k], comps[k]
+                constr_coefs = coefs[start:end]
+                if first:
+                    constr_vars = variables[start:end]
+                    if len(set(constr_vars)) < end - start:
+                        constr_coefs, constr_vars = merge_terms(constr_coefs, constr_vars)
+                        self.presolve_stats["merged_terms"] += end - start - len(constr_vars)
+                        replace_terms(coefs, variables, starts, ends, k, constr_coefs, constr_vars)
+                else:
+                    constr_vars = variables[start:end]
+                    rhs[k] -= sum(c * value[v] for c, v in zip(constr_coefs, constr_vars) if v in value)
+                    terms = [(c, v) for c, v in zip(constr_coefs, constr_vars) if v not in value]
+                    constr_coefs, constr_vars = array('i', [c for c, v in terms]), array('i', [v for c, v in terms])
+                    replace_terms(coefs, variables, starts, ends, k, constr_coefs, constr_vars)
+                key = (comp, rhs[k], constr_coefs.tostring())
+                outcome = outcomes.get(key)
+                if outcome is None:
+                    outcome = outcomes[key] = constr_outcome(constr_coefs, COMPS[comp], rhs[k])
+                if outcome == "infeasible":
+                    return None
+                if outcome == "satisfied":
+                    kept[k] = 0
+                    continue
+                if outcome[0]:
+                    loose.add(k)
+                else:
+                    loose.discard(k)
+                for i, x in outcome[1]:
+                    v = constr_vars[i]
+                    if value.setdefault(v, x) != x:
+                        return None
+                    fixed.add(v)
+            # The constraints with a variable fixed in this round, found from the positions of
+            # its terms. (Removed terms have the variable -1, so they aren't found.)
+            if fixed:
+                positions = compress(xrange(len(variables)), imap(fixed.__contains__, variables))
+                visit = sorted(set(bisect_right(starts, i) - 1 for i in positions))
             else:
-                print " ".join("{:+d} x{}".format(i, j+1) for i, j in c[0]), c[1], str(c[2]) + ";"
-            if not quiet: print "*"
-            
-    def write_flatzinc(self):
-        print "array[1..{}] of var 0..1: x;".format(len(self.var_names))
-        print "var int: obj :: output_var;"
-        print "constraint int_lin_eq([{},-1],[{},obj],0);".format(
-                ",".join(str(t[0]) for t in self.objective),
-                ",".join("x[{}]".format(t[1]+1) for t in self.objective))
-        for c in self.constrs:
-            if c.comp == "<=":
-                print "constraint int_lin_le([{}],[{}],{});".format(
-                        ",".join(str(t[0]) for t in c.terms),
-                        ",".join("x[{}]".format(t[1]+1) for t in c.terms),
-                        c.rhs)
-            elif c.comp == ">=":
-                print "constraint int_lin_le([{}],[{}],{});".format(
-                        ",".join(str(-t[0]) for t in c.terms),
-                        ",".join("x[{}]".format(t[1]+1) for t in c.terms),
-                        -c.rhs)
-            elif c.comp == "=":
-                print "constraint int_lin_eq([{}],[{}],{});".format(
-                        ",".join(str(t[0]) for t in c.terms),
-                        ",".join("x[{}]".format(t[1]+1) for t in c.terms),
-                        c.rhs)
-        print "solve maximize obj;"
-            
-    def write(self, quiet):
-        if self.flatzinc:
-            self.write_flatzinc()
+                visit = []
+            first = False
+        return value
+
+    def constr_name_id(self, name):
+        name_id = self.constr_name_ids.get(name)
+        if name_id is None:
+            name_id = self.constr_name_ids[name] = len(self.constr_names)
+            self.constr_names.append(name)
+        return name_id
+
+    def write_spooled(self, out):
+        "Copy the spooled constraints (if any) to out"
+        if self.spool is not None:
+            copy_spool(self.spool, out)
+
+    def write_hint(self, f):
+        "Write the hint to file object f as a line of literals, in the format of a solver's v line"
+        if self.use_presolve:
+            self.presolve()
+        out = ModelWriter(f)
+        out.write("v " + " ".join(("x{}" if value else "-x{}").format(v+1) for v, value in self.hint))
+        out.flush()
+
+    def write(self, quiet, f):
+        "Write the model to file object f"
+        if self.use_presolve:
+            self.presolve()
+        out = ModelWriter(f)
+        var_names = None
+        if not quiet and self.fmt != "flatzinc":
+            var_names = self.output_var_names()   # format each name once, rather than once per use
+        if self.fmt == "flatzinc":
+            self.write_flatzinc(out)
+        elif self.fmt == "wcnf":
+            self.write_wcnf(out, quiet, var_names)
+        elif self.fmt == "lp":
+            self.write_lp(out, quiet, var_names)
+        elif self.fmt == "mps":
+            self.write_mps(out, quiet, var_names)
         else:  # .opb
-            self.write_model_size_comment()
+            self.write_model_size_comment(out)
             if not quiet:
-                self.show_var_names()
-                self.show_objective()
-            self.write_model(quiet)
-
+                self.show_var_names(out, var_names)
+                self.show_objective(out, var_names)
+            self.write_model(out, quiet, var_names)
+        out.flush()
@@ -0,0 +1,163 @@
+import argparse
+import re
+import signal
+import sys
+import time
+
+# A small branch-and-bound solver for .opb models, with output in the format of the PB competition.
+# It is only intended for small instances, as a stand-in for a real solver when trying out hrc-solve.py.
+
+TERM = re.compile(r"([+-]?\d+)\s+(~?)x(\d+)")
+
+def read_opb(f):
+    """Returns (num_vars, objective, constraints). The objective is a list of (coef, var) to minimise.
+       Each constraint is a list of (coef, lit) and a bound, meaning sum(coef * lit) >= bound,
+       with each coef positive; lit is var+1 for a variable or -(var+1) for its negation.
+    """
+    num_vars = 0
+    objective = []
+    constraints = []
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith("*"):
+            continue
+        if line.startswith("min:"):
+            objective = [(int(c), int(v) - 1) for c, neg, v in TERM.findall(line[4:])]
+            num_vars = max([num_vars] + [v + 1 for c, v in objective])
+            continue
+        lhs, comp, rhs = re.match(r"(.*?)(>=|=)\s*([+-]?\d+)\s*;", line).groups()
+        terms = [(int(c), -int(v) if neg else int(v)) for c, neg, v in TERM.findall(lhs)]
+        num_vars = max([num_vars] + [abs(lit) for c, lit in terms])
+        constraints.append(normalise(terms, int(rhs)))
+        if comp == "=":
+            constraints.append(normalise([(-c, lit) for c, lit in terms], -int(rhs)))
+    return num_vars, objective, constraints
+
+def normalise(terms, bound):
+    "Rewrite sum(coef * lit) >= bound with positive coefficients, using 1 - lit for negative ones"
+    result = []
+    for c, lit in terms:
+        if c < 0:
+            result.append((-c, -lit))
+            bound -= c
+        elif c > 0:
+            result.append((c, lit))
+    return result, bound
+
+class Solver(object):
+    def __init__(self, num_vars, objective, constraints):
+        self.num_vars = num_vars
+        self.objective = objective
+        self.constraints = constraints
+        self.value = [None] * (num_vars + 1)   # indexed by var+1
+        self.slack = [sum(c for c, lit in terms) - bound for terms, bound in constraints]
+        self.max_coef = [max([0] + [c for c, lit in terms]) for terms, bound in constraints]
+        self.watches = [[] for v in range(num_vars + 1)]   # constraints containing each var, with coef and sign
+        for k, (terms, bound) in enumerate(constraints):
+            for c, lit in terms:
+                self.watches[abs(lit)].append((k, c, lit > 0))
+        self.obj_coef = [0] * (num_vars + 1)
+        for c, v in objective:
+            self.obj_coef[v + 1] += c
+        self.obj_terms = [(c, v) for v, c in enumerate(self.obj_coef) if c]
+        self.trail = []
+        self.best = None
+        self.best_value = None
+
+    def assign(self, var, value):
+        "Assign var, and propagate. Returns False on a conflict."
+        queue = [(var, value)]
+        while queue:
+            var, value = queue.pop()
+            if self.value[var] is not None:
+                if self.value[var] != value:
+                    return False
+                continue
+            self.value[var] = value
+            self.trail.append(var)
+            conflict = False
+            for k, c, positive in self.watches[var]:
+                if value != positive:   # the literal is false
+                    self.slack[k] -= c
+                    conflict = conflict or self.slack[k] < 0
+            if conflict:
+                return False
+            for k, c, positive in self.watches[var]:
+                if value != positive and self.slack[k] < self.max_coef[k]:
+                    for c2, lit in self.constraints[k][0]:
+                        if c2 > self.slack[k] and self.value[abs(lit)] is None:
+                            queue.append((abs(lit), lit > 0))
+        return True
+
+    def propagate_constraints(self):
+        "Propagate each constraint before the search. Returns False if one can't be satisfied."
+        for k, (terms, bound) in enumerate(self.constraints):
+            if self.slack[k] < 0:
+                return False
+            for c, lit in terms:
+                if c > self.slack[k] and self.value[abs(lit)] is None and not self.assign(abs(lit), lit > 0):
+                    return False
+        return True
+
+    def undo(self, trail_len):
+        while len(self.trail) > trail_len:
+            var = self.trail.pop()
+            value = self.value[var]
+            for k, c, positive in self.watches[var]:
+                if value != positive:
+                    self.slack[k] += c
+            self.value[var] = None
+
+    def objective_bound(self):
+        return sum(c * self.value[v] if self.value[v] is not None else min(c, 0)
+                   for c, v in self.obj_terms)
+
+    def search(self, var=1):
+        if self.best is not None and self.objective_bound() >= self.best:
+            return
+        while var <= self.num_vars and self.value[var] is not None:
+            var += 1
+        if var > self.num_vars:
+            self.best = self.objective_bound()
+            self.best_value = list(self.value)
+            print "o {}".format(self.best)
+            sys.stdout.flush()
+            return
+        for value in ([True, False] if self.obj_coef[var] < 0 else [False, True]):
+            trail_len = len(self.trail)
+            if self.assign(var, value):
+                self.search(var + 1)
+            self.undo(trail_len)
+
+def show_solution(solver, status):
+    print "s " + status
+    if solver.best_value is not None:
+        print "v " + " ".join(("x{}" if value else "-x{}").format(v)
+                              for v, value in enumerate(solver.best_value) if v > 0)
+    sys.stdout.flush()
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser("Solve a small .opb model")
+    parser.add_argument("model", nargs="?",
+            help="Model file (default: stdin)")
+    parser.add_argument("--delay", type=float, default=0.0,
+            help="Wait this many seconds before solving, to act like a slow solver")
+    args = parser.parse_args()
+
+    if args.model:
+        with open(args.model) as f:
+            problem = read_opb(f)
+    else:
+        problem = read_opb(sys.stdin)
+    solver = Solver(*problem)
+
+    def interrupted(signum, frame):
+        show_solution(solver, "SATISFIABLE" if solver.best is not None else "UNKNOWN")
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, interrupted)
+
+    time.sleep(args.delay)
+    sys.setrecursionlimit(10 * solver.num_vars + 1000)
+    if solver.propagate_constraints():
+        solver.search()
+    show_solution(solver, "OPTIMUM FOUND" if solver.best is not None else "UNSATISFIABLE")